@@ -0,0 +1,81 @@
+import argparse
+import gc
+import json
+import torch
+from gan_training.models import generator_dict, discriminator_dict
+from gan_training.profiling import time_steps, reset_peak_memory, peak_memory
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Peak memory and step time per number of checkpoint segments.'
+)
+parser.add_argument('--models',
+                    type=str,
+                    nargs='+',
+                    default=['resnet', 'resnet2'],
+                    help='Models to benchmark, all at --size.')
+parser.add_argument('--size', type=int, default=128)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--nfilter', type=int, default=64)
+parser.add_argument('--nfilter-max', type=int, default=1024)
+parser.add_argument('--z-dim', type=int, default=256)
+parser.add_argument('--segments', type=int, nargs='+', default=[0, 1, 2, 4])
+parser.add_argument('--steps', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+device = torch.device("cuda:0" if is_cuda else "cpu")
+
+kwargs = dict(nfilter=args.nfilter, nfilter_max=args.nfilter_max)
+x = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+y = torch.zeros(args.batch_size, dtype=torch.int64, device=device)
+z = torch.randn(args.batch_size, args.z_dim, device=device)
+
+
+def step(generator, discriminator):
+    # One D step on real and fake data, one G step through D
+    generator.zero_grad(set_to_none=True)
+    discriminator.zero_grad(set_to_none=True)
+    with torch.no_grad():
+        x_fake = generator(z, y)
+    dloss = discriminator(x, y).mean() - discriminator(x_fake, y).mean()
+    dloss.backward()
+    gloss = discriminator(generator(z, y), y).mean()
+    gloss.backward()
+
+
+results = []
+print('%-10s %8s %14s %12s' % ('model', 'segments', 'peak MB', 'step ms'))
+for model in args.models:
+    generator = generator_dict[model](z_dim=args.z_dim,
+                                      nlabels=1,
+                                      size=args.size,
+                                      **kwargs).to(device)
+    discriminator = discriminator_dict[model](args.z_dim,
+                                              nlabels=1,
+                                              size=args.size,
+                                              **kwargs).to(device)
+    for segments in args.segments:
+        generator.checkpoint_segments = segments
+        discriminator.checkpoint_segments = segments
+        gc.collect()
+        reset_peak_memory(device)
+        t = time_steps(lambda: step(generator, discriminator), args.steps,
+                       args.warmup, device)
+        peak = peak_memory(device) / 2**20
+        results.append(
+            dict(model=model,
+                 size=args.size,
+                 batch_size=args.batch_size,
+                 segments=segments,
+                 peak_mb=peak,
+                 step_ms=t * 1e3))
+        print('%-10s %8d %14.1f %12.2f' % (model, segments, peak, t * 1e3))
+    del generator, discriminator
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,95 @@
+import argparse
+import json
+import torch
+from gan_training.models import generator_dict, discriminator_dict
+from gan_training.profiling import time_steps
+
+# Smallest image size each architecture supports
+model_sizes = {
+    'resnet': 32,
+    'resnet_nobias': 32,
+    'resnet1': 32,
+    'resnet2': 32,
+    'resnet3': 64,
+    'resnet4': 64,
+}
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Compare NCHW and channels_last training steps per model.')
+parser.add_argument('--models',
+                    type=str,
+                    nargs='+',
+                    default=list(model_sizes.keys()))
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--nfilter', type=int, default=32)
+parser.add_argument('--nfilter-max', type=int, default=256)
+parser.add_argument('--z-dim', type=int, default=256)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=2)
+parser.add_argument('--threads', type=int, default=0)
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+device = torch.device("cuda:0" if is_cuda else "cpu")
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+
+def benchmark(name, memory_format):
+    torch.manual_seed(0)
+    size = model_sizes[name]
+    kwargs = dict(nfilter=args.nfilter, nfilter_max=args.nfilter_max)
+    generator = generator_dict[name](z_dim=args.z_dim,
+                                     nlabels=1,
+                                     size=size,
+                                     **kwargs).to(device)
+    discriminator = discriminator_dict[name](args.z_dim,
+                                             nlabels=1,
+                                             size=size,
+                                             **kwargs).to(device)
+    if memory_format == torch.channels_last:
+        generator = generator.to(memory_format=memory_format)
+        discriminator = discriminator.to(memory_format=memory_format)
+        generator.channels_last = True
+        discriminator.channels_last = True
+
+    x = torch.randn(args.batch_size, 3, size, size, device=device)
+    x = x.contiguous(memory_format=memory_format)
+    y = torch.zeros(args.batch_size, dtype=torch.int64, device=device)
+    z = torch.randn(args.batch_size, args.z_dim, device=device)
+
+    def step():
+        # One D step on real and fake data, one G step through D
+        generator.zero_grad()
+        discriminator.zero_grad()
+        with torch.no_grad():
+            x_fake = generator(z, y)
+        dloss = discriminator(x, y).mean() - discriminator(x_fake, y).mean()
+        dloss.backward()
+        gloss = discriminator(generator(z, y), y).mean()
+        gloss.backward()
+
+    return time_steps(step, args.steps, args.warmup, device)
+
+
+results = []
+print('%-14s %12s %14s %8s' % ('model', 'nchw ms', 'nhwc ms', 'speedup'))
+for name in args.models:
+    t_nchw = benchmark(name, torch.contiguous_format)
+    t_nhwc = benchmark(name, torch.channels_last)
+    results.append(
+        dict(model=name,
+             size=model_sizes[name],
+             batch_size=args.batch_size,
+             nchw_ms=t_nchw * 1e3,
+             channels_last_ms=t_nhwc * 1e3,
+             speedup=t_nchw / t_nhwc))
+    print('%-14s %12.2f %14.2f %7.2fx' %
+          (name, t_nchw * 1e3, t_nhwc * 1e3, t_nchw / t_nhwc))
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
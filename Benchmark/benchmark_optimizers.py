@@ -0,0 +1,193 @@
+import argparse
+import json
+import numpy as np
+import torch
+from torch import optim
+from gan_training.models import generator_dict, discriminator_dict
+from gan_training.pid_optimizer import PID_RMSprop
+from gan_training.profiling import time_steps
+
+# Optimizers under test, PID_RMSprop with the terms of the name switched on
+optimizer_dict = {
+    'sgd': lambda params, args: optim.SGD(params, lr=args.lr, momentum=0.),
+    'rmsprop': lambda params, args: optim.RMSprop(
+        params, lr=args.lr, alpha=0.99, eps=1e-8),
+    'adam': lambda params, args: optim.Adam(
+        params, lr=args.lr, betas=(0., 0.99), eps=1e-8),
+    'pid': lambda params, args: pid_optimizer(params, args),
+    'pid-p': lambda params, args: pid_optimizer(params, args, vp=args.vp),
+    'pid-i': lambda params, args: pid_optimizer(params, args, vi=args.vi),
+    'pid-d': lambda params, args: pid_optimizer(params, args, vd=args.vd),
+    'pid-pid': lambda params, args: pid_optimizer(
+        params, args, vp=args.vp, vi=args.vi, vd=args.vd),
+    'pid-centered': lambda params, args: pid_optimizer(
+        params, args, vi=args.vi, centered=True),
+}
+
+# Step implementations of PID_RMSprop
+pid_modes = {
+    'loop': dict(),
+    'foreach': dict(foreach=True),
+    'flat': dict(flat=True),
+}
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Time single optimizer steps of PID_RMSprop and the torch '
+    'optimizers on the parameters of the G and D architectures.')
+parser.add_argument('--models',
+                    type=str,
+                    nargs='+',
+                    default=list(discriminator_dict.keys()))
+parser.add_argument('--optimizers',
+                    type=str,
+                    nargs='+',
+                    default=list(optimizer_dict.keys()))
+parser.add_argument('--pid-modes',
+                    type=str,
+                    nargs='+',
+                    default=list(pid_modes.keys()))
+parser.add_argument('--nfilters',
+                    type=int,
+                    nargs='+',
+                    default=[16, 32, 64],
+                    help='Widths of the models, for the scaling with the '
+                    'parameter count.')
+parser.add_argument('--size', type=int, default=32)
+parser.add_argument('--nlabels', type=int, default=1)
+parser.add_argument('--lr', type=float, default=1e-4)
+parser.add_argument('--vp', type=float, default=1e-4)
+parser.add_argument('--vi', type=float, default=1e-4)
+parser.add_argument('--vd', type=float, default=1e-4)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--warmup', type=int, default=3)
+parser.add_argument('--threads', type=int, default=0)
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+device = torch.device("cuda:0" if is_cuda else "cpu")
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+
+def pid_optimizer(params, args, **kwargs):
+    return PID_RMSprop(params,
+                       lr=args.lr,
+                       alpha=0.99,
+                       eps=1e-8,
+                       **dict(kwargs, **pid_modes[args.pid_mode]))
+
+
+def get_params(model_dict, name, nfilter):
+    torch.manual_seed(0)
+    model = model_dict[name](256,
+                             nlabels=args.nlabels,
+                             size=args.size,
+                             nfilter=nfilter,
+                             nfilter_max=16 * nfilter)
+    # Leaf parameters as in a model, flat mode hooks their gradients
+    params = [
+        p.detach().clone().to(device).requires_grad_()
+        for p in model.parameters()
+    ]
+    for p in params:
+        p.grad = torch.randn_like(p) * 1e-2
+    return params
+
+
+def state_bytes(optimizer, params):
+    ''' Bytes of the optimizer state, without tensors that alias the
+    parameters (the derivative buffer of PID_RMSprop).
+    '''
+    param_ptrs = set(p.data_ptr() for p in params)
+    nbytes = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if (torch.is_tensor(value) and value.dim() > 0
+                    and value.data_ptr() not in param_ptrs):
+                nbytes += value.numel() * value.element_size()
+    return nbytes
+
+
+def run(params, name):
+    optimizer = optimizer_dict[name](params, args)
+    t = time_steps(optimizer.step, args.steps, args.warmup, device)
+    nparams = sum(p.numel() for p in params)
+    return dict(us_per_step=t * 1e6,
+                ns_per_param=t * 1e9 / nparams,
+                state_bytes_per_param=state_bytes(optimizer, params) /
+                nparams)
+
+
+def optimizer_settings():
+    for name in args.optimizers:
+        if name.startswith('pid'):
+            for pid_mode in args.pid_modes:
+                yield name, pid_mode
+        else:
+            yield name, None
+
+
+results = []
+print('%-14s %-8s %-14s %-8s %10s %12s %12s %12s' %
+      ('model', 'net', 'optimizer', 'mode', 'nfilter', 'params',
+       'us/step', 'state B/p'))
+for model_name in args.models:
+    for net, model_dict in [('generator', generator_dict),
+                            ('discriminator', discriminator_dict)]:
+        for nfilter in args.nfilters:
+            try:
+                params = get_params(model_dict, model_name, nfilter)
+            except Exception as e:
+                print('Skipping %s %s: %s' % (model_name, net, e))
+                break
+            nparams = sum(p.numel() for p in params)
+            for name, pid_mode in optimizer_settings():
+                args.pid_mode = pid_mode
+                result = dict(model=model_name,
+                              net=net,
+                              optimizer=name,
+                              pid_mode=pid_mode,
+                              nfilter=nfilter,
+                              nparams=nparams,
+                              ntensors=len(params))
+                result.update(run(params, name))
+                results.append(result)
+                print('%-14s %-8s %-14s %-8s %10d %12d %12.1f %12.1f' %
+                      (model_name, net[0], name, pid_mode or '-', nfilter,
+                       nparams, result['us_per_step'],
+                       result['state_bytes_per_param']))
+
+# Scaling of the step time with the parameter count, as the exponent of a
+# power law fitted over models and widths
+scaling = []
+for name, pid_mode in optimizer_settings():
+    settings = [
+        r for r in results
+        if r['optimizer'] == name and r['pid_mode'] == pid_mode
+    ]
+    if len(set(r['nparams'] for r in settings)) < 2:
+        continue
+    exponent, _ = np.polyfit(np.log([r['nparams'] for r in settings]),
+                             np.log([r['us_per_step'] for r in settings]), 1)
+    scaling.append(dict(optimizer=name,
+                        pid_mode=pid_mode,
+                        exponent=float(exponent),
+                        ns_per_param=float(
+                            np.median([r['ns_per_param']
+                                       for r in settings]))))
+print('%-14s %-8s %10s %14s' % ('optimizer', 'mode', 'exponent', 'ns/param'))
+for s in scaling:
+    print('%-14s %-8s %10.2f %14.3f' % (s['optimizer'], s['pid_mode'] or '-',
+                                        s['exponent'], s['ns_per_param']))
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(dict(device=str(device),
+                       threads=torch.get_num_threads(),
+                       results=results,
+                       scaling=scaling),
+                  f,
+                  indent=2)
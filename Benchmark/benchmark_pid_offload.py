@@ -0,0 +1,73 @@
+import argparse
+import json
+import tempfile
+import torch
+from gan_training.models import discriminator_dict
+from gan_training.pid_optimizer import PID_RMSprop
+from gan_training.profiling import time_steps, reset_peak_memory, peak_memory
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Step time and device memory of PID_RMSprop with its state '
+    'on the device, in pinned host memory and in mmap files.')
+parser.add_argument('--model', type=str, default='resnet')
+parser.add_argument('--size', type=int, default=256)
+parser.add_argument('--nfilter', type=int, default=64)
+parser.add_argument('--nfilter-max', type=int, default=1024)
+parser.add_argument('--vi', type=float, default=1e-4)
+parser.add_argument('--vd', type=float, default=0.)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=2)
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+device = torch.device("cuda:0" if is_cuda else "cpu")
+
+torch.manual_seed(0)
+model = discriminator_dict[args.model](256,
+                                       nlabels=1,
+                                       size=args.size,
+                                       nfilter=args.nfilter,
+                                       nfilter_max=args.nfilter_max)
+offload_dir = tempfile.mkdtemp()
+# The same gradients for every run, so that the runs can be compared
+grads = [torch.randn_like(p).to(device) * 1e-2 for p in model.parameters()]
+
+
+def run(offload):
+    params = [p.detach().clone().to(device) for p in model.parameters()]
+    for p, grad in zip(params, grads):
+        p.grad = grad.clone()
+    optimizer = PID_RMSprop(params,
+                            lr=1e-4,
+                            vi=args.vi,
+                            vd=args.vd,
+                            offload=offload,
+                            offload_dir=offload_dir)
+    reset_peak_memory(device)
+    t = time_steps(optimizer.step, args.steps, args.warmup, device)
+    return params, t, peak_memory(device)
+
+
+results = []
+params_ref, t_ref, _ = run(None)
+print('%-8s %10s %10s %14s %14s' %
+      ('offload', 'step ms', 'slowdown', 'peak MB', 'max abs diff'))
+for offload in [None, 'pinned', 'mmap']:
+    params, t, peak = run(offload)
+    diff = max((p - p_ref).abs().max().item()
+               for p, p_ref in zip(params, params_ref))
+    results.append(
+        dict(offload=str(offload),
+             step_ms=t * 1e3,
+             slowdown=t / t_ref,
+             peak_mb=peak / 2**20,
+             max_abs_diff=diff))
+    print('%-8s %10.2f %9.2fx %14.1f %14.3e' %
+          (offload, t * 1e3, t / t_ref, peak / 2**20, diff))
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
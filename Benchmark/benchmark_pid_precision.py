@@ -0,0 +1,102 @@
+import argparse
+import json
+import torch
+from gan_training.models import discriminator_dict
+from gan_training.pid_optimizer import PID_RMSprop
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Memory and accuracy of reduced-precision PID_RMSprop state '
+    'against fp32 state, on synthetic gradients.')
+parser.add_argument('--model', type=str, default='resnet1')
+parser.add_argument('--size', type=int, default=32)
+parser.add_argument('--nfilter', type=int, default=64)
+parser.add_argument('--nfilter-max', type=int, default=1024)
+parser.add_argument('--steps', type=int, default=1000)
+parser.add_argument('--lr', type=float, default=1e-4)
+parser.add_argument('--vp', type=float, default=0.)
+parser.add_argument('--vi', type=float, default=1e-4)
+parser.add_argument('--vd', type=float, default=0.)
+parser.add_argument('--flat', action='store_true')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+variants = [
+    ('fp32', 'kahan'),
+    ('bf16', 'kahan'),
+    ('bf16', 'stochastic'),
+    ('bf16', 'nearest'),
+]
+
+torch.manual_seed(0)
+model = discriminator_dict[args.model](256,
+                                       nlabels=1,
+                                       size=args.size,
+                                       nfilter=args.nfilter,
+                                       nfilter_max=args.nfilter_max)
+
+
+def run(state_precision, integral_rounding):
+    params = [p.detach().clone().requires_grad_() for p in model.parameters()]
+    optimizer = PID_RMSprop(params,
+                            lr=args.lr,
+                            vp=args.vp,
+                            vi=args.vi,
+                            vd=args.vd,
+                            flat=args.flat,
+                            state_precision=state_precision,
+                            integral_rounding=integral_rounding)
+    for it in range(args.steps):
+        # The same gradients for every variant
+        g = torch.Generator()
+        g.manual_seed(it)
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=g) * 1e-2
+        optimizer.step()
+
+    # The derivative buffer aliases the parameters and is not counted
+    state_bytes = 0
+    integral = []
+    for p in params:
+        state = optimizer.state[p]
+        for key, value in state.items():
+            if torch.is_tensor(value) and key != 'd_buffer':
+                state_bytes += value.numel() * value.element_size()
+        if 'i_buffer' in state:
+            i_buffer = state['i_buffer'].float()
+            if 'i_buffer_comp' in state:
+                i_buffer += state['i_buffer_comp'].float()
+            integral.append(i_buffer.flatten())
+    params = torch.cat([p.detach().flatten() for p in params])
+    if len(integral) > 0:
+        integral = torch.cat(integral)
+    else:
+        integral = None
+    return params, integral, state_bytes
+
+
+def relative_error(x, x_ref):
+    return ((x - x_ref).norm() / x_ref.norm().clamp_min(1e-30)).item()
+
+
+results = []
+params_ref, integral_ref, bytes_ref = run('fp32', 'kahan')
+print('%-6s %-11s %12s %16s %16s' %
+      ('state', 'rounding', 'state MB', 'param rel err', 'integral rel err'))
+for state_precision, integral_rounding in variants:
+    params, integral, state_bytes = run(state_precision, integral_rounding)
+    result = dict(state_precision=state_precision,
+                  integral_rounding=integral_rounding,
+                  state_mb=state_bytes / 2**20,
+                  state_bytes_ratio=state_bytes / bytes_ref,
+                  param_rel_err=relative_error(params, params_ref))
+    if integral is not None:
+        result['integral_rel_err'] = relative_error(integral, integral_ref)
+    results.append(result)
+    print('%-6s %-11s %12.1f %16.3e %16.3e' %
+          (state_precision, integral_rounding, result['state_mb'],
+           result['param_rel_err'], result.get('integral_rel_err', 0.)))
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,88 @@
+import argparse
+import json
+import torch
+from torch import nn
+from gan_training.pid_optimizer import PID_RMSprop
+from gan_training.profiling import time_steps
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Time of an embedding training step and deviation of the '
+    'row-sparse PID_RMSprop step against the dense step, for a label '
+    'embedding with Zipf-distributed labels.')
+parser.add_argument('--nlabels', type=int, default=1000)
+parser.add_argument('--embed-size', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=64)
+parser.add_argument('--zipf', type=float, default=1.2,
+                    help='Exponent of the label frequencies.')
+parser.add_argument('--steps', type=int, default=1000)
+parser.add_argument('--lr', type=float, default=1e-4)
+parser.add_argument('--vp', type=float, default=0.)
+parser.add_argument('--vi', type=float, default=1e-4)
+parser.add_argument('--no-catch-up-hook',
+                    action='store_true',
+                    help='Look up stale rows, without register_catch_up.')
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+args = parser.parse_args()
+
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+device = torch.device("cuda:0" if is_cuda else "cpu")
+
+torch.manual_seed(0)
+weight = torch.randn(args.nlabels, args.embed_size, device=device)
+frequencies = torch.arange(1, args.nlabels + 1,
+                           dtype=torch.float).pow(-args.zipf)
+labels = torch.multinomial(frequencies,
+                           args.steps * args.batch_size,
+                           replacement=True).view(args.steps, -1).to(device)
+targets = torch.randn(args.steps, args.batch_size, args.embed_size,
+                      device=device)
+
+
+def run(sparse):
+    embedding = nn.Embedding(args.nlabels, args.embed_size,
+                             sparse=sparse).to(device)
+    embedding.weight.data.copy_(weight)
+    param = embedding.weight
+    optimizer = PID_RMSprop([param], lr=args.lr, vp=args.vp, vi=args.vi)
+    if sparse and not args.no_catch_up_hook:
+        optimizer.register_catch_up(embedding)
+    it = [0]
+
+    def step():
+        # The gradient depends on the looked-up rows, so rows that were
+        # not caught up before the lookup would get a different gradient
+        optimizer.zero_grad()
+        x = embedding(labels[it[0]])
+        loss = 0.5e-2 * (x - targets[it[0]]).pow(2).sum()
+        loss.backward()
+        optimizer.step()
+        it[0] += 1
+
+    t = time_steps(step, args.steps, 0, device)
+    if sparse:
+        catch_up_t = time_steps(optimizer.catch_up, 1, 0, device)
+    else:
+        catch_up_t = 0.
+    return param.detach(), t, catch_up_t
+
+
+param_dense, t_dense, _ = run(False)
+param_sparse, t_sparse, t_catch_up = run(True)
+result = dict(nlabels=args.nlabels,
+              embed_size=args.embed_size,
+              batch_size=args.batch_size,
+              vp=args.vp,
+              vi=args.vi,
+              catch_up_hook=not args.no_catch_up_hook,
+              dense_us_per_step=t_dense * 1e6,
+              sparse_us_per_step=t_sparse * 1e6,
+              catch_up_ms=t_catch_up * 1e3,
+              max_abs_diff=(param_sparse - param_dense).abs().max().item())
+for key, value in result.items():
+    print('%-20s %s' % (key, value))
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
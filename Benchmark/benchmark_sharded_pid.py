@@ -0,0 +1,134 @@
+import argparse
+import copy
+import json
+import os
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from gan_training.checkpoints import CheckpointIO
+from gan_training.models import discriminator_dict
+from gan_training.pid_optimizer import PID_RMSprop, ShardedPID_RMSprop
+from gan_training.profiling import time_steps
+
+# Sample shape of the benchmarked models
+model_shapes = {
+    'mlp1': (2, ),
+    'resnet1': (3, 32, 32),
+}
+
+
+def state_bytes(optimizer):
+    nbytes = 0
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            if torch.is_tensor(value) and key != 'd_buffer':
+                nbytes += value.numel() * value.element_size()
+    return nbytes
+
+
+def worker(rank, args, init_file, checkpoint_dir):
+    ''' Trains D with sharded and with full optimizer state, and checks that
+    parameters and gathered state agree.
+    '''
+    dist.init_process_group('gloo',
+                            init_method='file://' + init_file,
+                            rank=rank,
+                            world_size=args.world_size)
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    model = discriminator_dict[args.model](256,
+                                           nlabels=1,
+                                           size=32,
+                                           nfilter=32,
+                                           nfilter_max=256)
+    model_ref = copy.deepcopy(model)
+    kwargs = dict(lr=1e-4, vp=args.vp, vi=args.vi, vd=args.vd)
+    optimizer = ShardedPID_RMSprop(model.parameters(), **kwargs)
+    optimizer_ref = PID_RMSprop(model_ref.parameters(), **kwargs)
+    model = DistributedDataParallel(model)
+
+    # Identical batches on all ranks, so the averaged gradient equals the
+    # gradient of the reference
+    x = torch.randn((args.batch_size, ) + model_shapes[args.model])
+    y = torch.zeros(args.batch_size, dtype=torch.int64)
+
+    def step():
+        optimizer.zero_grad()
+        model(x, y).mean().backward()
+        optimizer.step()
+
+    def step_ref():
+        optimizer_ref.zero_grad()
+        model_ref(x, y).mean().backward()
+        optimizer_ref.step()
+
+    t = time_steps(step, args.steps, args.warmup)
+    t_ref = time_steps(step_ref, args.steps, args.warmup)
+    param_diff = max((p - p_ref).abs().max().item() for p, p_ref in zip(
+        model.module.parameters(), model_ref.parameters()))
+
+    # Save the gathered state through CheckpointIO and load it into a
+    # fresh sharded optimizer
+    checkpoint_io = CheckpointIO(checkpoint_dir, write=(rank == 0))
+    checkpoint_io.register_modules(d_optimizer=optimizer)
+    checkpoint_io.save('sharded.pt')
+    dist.barrier()
+    optimizer_loaded = ShardedPID_RMSprop(model.module.parameters(),
+                                          **kwargs)
+    checkpoint_io = CheckpointIO(checkpoint_dir)
+    checkpoint_io.register_modules(d_optimizer=optimizer_loaded)
+    checkpoint_io.load('sharded.pt')
+
+    state = optimizer_loaded.state_dict()['state']
+    state_ref = optimizer_ref.state_dict()['state']
+    state_diff = 0.
+    for index, state_p in state_ref.items():
+        for key, value in state_p.items():
+            if torch.is_tensor(value):
+                state_diff = max(
+                    state_diff,
+                    (state[index][key] - value).abs().max().item())
+
+    local_bytes = 0
+    if optimizer.optimizer is not None:
+        local_bytes = state_bytes(optimizer.optimizer)
+    local_bytes = [local_bytes] * args.world_size
+    dist.all_gather_object(local_bytes, local_bytes[rank])
+
+    if rank == 0:
+        result = dict(model=args.model,
+                      world_size=args.world_size,
+                      step_ms=t * 1e3,
+                      step_ms_unsharded=t_ref * 1e3,
+                      state_mb_per_rank=[b / 2**20 for b in local_bytes],
+                      state_mb_unsharded=state_bytes(optimizer_ref) / 2**20,
+                      max_param_diff=param_diff,
+                      max_state_diff=state_diff)
+        for key, value in result.items():
+            print('%-20s %s' % (key, value))
+        if len(args.out) > 0:
+            with open(args.out, 'w') as f:
+                json.dump(result, f, indent=2)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sharded PID_RMSprop over gloo with local processes.')
+    parser.add_argument('--world-size', type=int, default=2)
+    parser.add_argument('--model', type=str, default='resnet1')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--vp', type=float, default=0.)
+    parser.add_argument('--vi', type=float, default=1e-4)
+    parser.add_argument('--vd', type=float, default=0.)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--out', type=str, default='', help='Output json file.')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    mp.spawn(worker,
+             args=(args, os.path.join(tmp_dir, 'init'), tmp_dir),
+             nprocs=args.world_size)
@@ -0,0 +1,222 @@
+import argparse
+import copy
+import gc
+import itertools
+import json
+import sys
+import torch
+from gan_training.config import load_config, build_models, build_optimizers
+from gan_training.profiling import time_steps, reset_peak_memory, peak_memory
+from gan_training.train import Trainer as Trainer_reg
+from gan_training.train_pid import Trainer as Trainer_pid
+
+# Sample shape and kwargs of the benchmarked models
+model_settings = {
+    'mlp1': dict(shape=(2, ), size=32, kwargs=dict()),
+    'resnet1': dict(shape=(3, 32, 32),
+                    size=32,
+                    kwargs=dict(nfilter=32, nfilter_max=256)),
+}
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Time the D and G steps of both trainers on the CPU over a '
+    'matrix of GAN, PID and regularization settings.')
+parser.add_argument('--models',
+                    type=str,
+                    nargs='+',
+                    default=list(model_settings.keys()))
+parser.add_argument('--gan-types',
+                    type=str,
+                    nargs='+',
+                    default=['standard', 'wgan', 'hinge'])
+parser.add_argument('--pid-types',
+                    type=str,
+                    nargs='+',
+                    default=['function', 'square', 'abs', 'accurate'])
+parser.add_argument('--reg-types',
+                    type=str,
+                    nargs='+',
+                    default=['none', 'real', 'wgangp'])
+parser.add_argument('--batch-size', type=int, default=64)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=2)
+parser.add_argument('--threads', type=int, default=0)
+parser.add_argument('--out', type=str, default='', help='Output json file.')
+parser.add_argument('--baseline',
+                    type=str,
+                    default='',
+                    help='Json file of a previous run to compare against.')
+parser.add_argument('--tolerance',
+                    type=float,
+                    default=0.1,
+                    help='Relative slowdown or memory growth flagged as a '
+                    'regression.')
+args = parser.parse_args()
+
+device = torch.device('cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+base_config = load_config('configs/default.yaml', None)
+base_config['training'].update(optimizer='rmsprop',
+                               batch_size=args.batch_size,
+                               i_buffer_factor=100,
+                               regularize_output_d=0.,
+                               sigmoid_coe=1.,
+                               pv=1.,
+                               pid_type='function')
+
+
+def settings():
+    ''' Yields the benchmarked settings, PID trainer first. '''
+    for model, gan_type in itertools.product(args.models, args.gan_types):
+        base = dict(model=model, gan_type=gan_type)
+        for iv, dv in itertools.product([0., 1.], [0., 1.]):
+            pid_types = args.pid_types if iv > 0 else ['none']
+            for pid_type in pid_types:
+                yield dict(base,
+                           trainer='pid',
+                           reg_type='none',
+                           pid_type=pid_type,
+                           iv=iv,
+                           dv=dv)
+        for reg_type in args.reg_types:
+            # The gradient penalty of train.Trainer assumes image batches
+            if (reg_type.startswith('wgangp')
+                    and len(model_settings[model]['shape']) != 3):
+                continue
+            yield dict(base,
+                       trainer='reg',
+                       reg_type=reg_type,
+                       pid_type='none',
+                       iv=0.,
+                       dv=0.)
+
+
+def setting_key(setting):
+    return '%(trainer)s/%(model)s/%(gan_type)s/%(reg_type)s/%(pid_type)s/' \
+        'iv=%(iv)g/dv=%(dv)g' % setting
+
+
+def benchmark(setting):
+    torch.manual_seed(0)
+    model = model_settings[setting['model']]
+    config = copy.deepcopy(base_config)
+    config['generator'].update(name=setting['model'], kwargs=model['kwargs'])
+    config['discriminator'].update(name=setting['model'],
+                                   kwargs=model['kwargs'])
+    config['data'].update(img_size=model['size'], nlabels=1)
+    config['training'].update(gan_type=setting['gan_type'],
+                              reg_type=setting['reg_type'],
+                              iv=setting['iv'],
+                              dv=setting['dv'])
+    if setting['pid_type'] != 'none':
+        config['training']['pid_type'] = setting['pid_type']
+
+    generator, discriminator = build_models(config)
+    g_optimizer, d_optimizer = build_optimizers(generator, discriminator,
+                                                config)
+    kwargs = dict(gan_type=setting['gan_type'],
+                  reg_type=setting['reg_type'],
+                  reg_param=10.)
+    if setting['trainer'] == 'pid':
+        trainer = Trainer_pid(generator,
+                              discriminator,
+                              g_optimizer,
+                              d_optimizer,
+                              pv=1.,
+                              iv=setting['iv'],
+                              dv=setting['dv'],
+                              batch_size=args.batch_size,
+                              config=config,
+                              **kwargs)
+    else:
+        trainer = Trainer_reg(generator, discriminator, g_optimizer,
+                              d_optimizer, **kwargs)
+
+    x_real = torch.randn((args.batch_size, ) + model['shape'])
+    y = torch.zeros(args.batch_size, dtype=torch.int64)
+    z_dim = config['z_dist']['dim']
+    it = [0]
+
+    def d_step():
+        it[0] += 1
+        z = torch.randn(args.batch_size, z_dim)
+        if setting['trainer'] == 'pid':
+            trainer.discriminator_trainstep(x_real, y, z, it[0])
+        else:
+            trainer.discriminator_trainstep(x_real.clone(), y, z)
+
+    def g_step():
+        z = torch.randn(args.batch_size, z_dim)
+        trainer.generator_trainstep(y, z)
+
+    gc.collect()
+    reset_peak_memory(device)
+    t_d = time_steps(d_step, args.steps, args.warmup, device)
+    t_g = time_steps(g_step, args.steps, args.warmup, device)
+    return dict(setting,
+                key=setting_key(setting),
+                steps_per_sec=1. / (t_d + t_g),
+                d_step_ms=t_d * 1e3,
+                g_step_ms=t_g * 1e3,
+                peak_mb=peak_memory(device) / 2**20)
+
+
+def add_component_costs(results):
+    ''' Adds the cost of the integral and derivative terms of every PID
+    setting, as its D step time minus the one without the term.
+    '''
+    by_key = dict((r['key'], r) for r in results)
+    for r in results:
+        if r['trainer'] != 'pid':
+            continue
+        if r['iv'] > 0:
+            ref = by_key[setting_key(dict(r, iv=0., pid_type='none'))]
+            r['integral_ms'] = r['d_step_ms'] - ref['d_step_ms']
+        if r['dv'] > 0:
+            ref = by_key[setting_key(dict(r, dv=0.))]
+            r['derivative_ms'] = r['d_step_ms'] - ref['d_step_ms']
+
+
+def compare(results, baseline):
+    ''' Returns the settings that got slower or use more memory. '''
+    baseline = dict((r['key'], r) for r in baseline)
+    regressions = []
+    for r in results:
+        ref = baseline.get(r['key'])
+        if ref is None:
+            continue
+        slowdown = ref['steps_per_sec'] / r['steps_per_sec'] - 1.
+        growth = r['peak_mb'] / ref['peak_mb'] - 1.
+        if slowdown > args.tolerance or growth > args.tolerance:
+            regressions.append(
+                dict(key=r['key'], slowdown=slowdown, memory_growth=growth))
+    return regressions
+
+
+results = []
+print('%-58s %10s %10s %10s %10s' %
+      ('setting', 'steps/s', 'D ms', 'G ms', 'peak MB'))
+for setting in settings():
+    r = benchmark(setting)
+    results.append(r)
+    print('%-58s %10.2f %10.2f %10.2f %10.1f' %
+          (r['key'], r['steps_per_sec'], r['d_step_ms'], r['g_step_ms'],
+           r['peak_mb']))
+add_component_costs(results)
+
+if len(args.out) > 0:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+if len(args.baseline) > 0:
+    with open(args.baseline, 'r') as f:
+        regressions = compare(results, json.load(f))
+    for r in regressions:
+        print('REGRESSION %-58s %+7.1f%% time %+7.1f%% memory' %
+              (r['key'], 100 * r['slowdown'], 100 * r['memory_growth']))
+    if len(regressions) > 0:
+        sys.exit(1)
+    print('No regressions against %s' % args.baseline)
@@ -0,0 +1,172 @@
+# coding: utf-8
+import gc
+import copy
+import yaml
+import numpy as np
+import torch
+from gan_training.config import (
+    build_models,
+    build_optimizers,
+    get_memory_format,
+)
+from gan_training.distributions import get_zdist
+from gan_training.profiling import (
+    time_steps,
+    reset_peak_memory,
+    peak_memory,
+    total_memory,
+)
+from gan_training.train_pid import Trainer as Trainer_pid
+
+
+def probe_batch_size(config, trainer_class, sample_shape, device):
+    ''' Returns the batch size with the best throughput that fits in memory.
+
+    The candidates of config['auto_batch']['candidates'] are tried in
+    increasing order. Each runs a few synthetic D and G steps of a fresh
+    model through trainer_class, on the given device and in the configured
+    memory format. The footprint of a candidate is the measured peak memory
+    plus, on the CPU, the integral buffers of the PID trainer, which only
+    fill up over many steps. Once two candidates are measured, the next one
+    is skipped if the linear extrapolation of the footprint exceeds the
+    budget, so that a CPU probe is not killed by the OOM killer.
+
+    Args:
+        config (dict): config dictionary
+        trainer_class (class): Trainer of gan_training.train or train_pid
+        sample_shape (tuple): shape of one training sample
+        device (device): device to probe on
+    '''
+    probe_config = config['auto_batch']
+    candidates = sorted(probe_config['candidates'])
+    budget = probe_config['memory_budget'] * 2**30
+    if budget <= 0:
+        budget = 0.9 * total_memory(device)
+
+    results = []
+    for batch_size in candidates:
+        if len(results) >= 2:
+            r0, r1 = results[-2], results[-1]
+            slope = ((r1['footprint'] - r0['footprint']) /
+                     (r1['batch_size'] - r0['batch_size']))
+            predicted = r1['footprint'] + slope * (batch_size -
+                                                   r1['batch_size'])
+            if predicted > budget:
+                break
+
+        result = probe_step(config, trainer_class, sample_shape, device,
+                            batch_size)
+        if result is None:
+            break
+        print('batch_size %5d: %10.1f MB, %10.1f samples/sec' %
+              (batch_size, result['footprint'] / 2**20,
+               result['samples_per_sec']))
+        if result['footprint'] > budget:
+            break
+        results.append(result)
+
+    if len(results) == 0:
+        raise RuntimeError('No batch size in %s fits in %.1f GB.' %
+                           (candidates, budget / 2**30))
+
+    best = max(results, key=lambda r: r['samples_per_sec'])
+    return best['batch_size'], results
+
+
+def probe_step(config, trainer_class, sample_shape, device, batch_size):
+    ''' Measures one batch size, returns None if it runs out of memory. '''
+    config = copy.deepcopy(config)
+    config['training']['batch_size'] = batch_size
+    nsteps = config['auto_batch']['nsteps']
+
+    generator, discriminator = build_models(config)
+    generator = generator.to(device)
+    discriminator = discriminator.to(device)
+    g_optimizer, d_optimizer = build_optimizers(generator, discriminator,
+                                                config)
+    trainer = build_trainer(trainer_class, generator, discriminator,
+                            g_optimizer, d_optimizer, config)
+
+    zdist = get_zdist(config['z_dist']['type'],
+                      config['z_dist']['dim'],
+                      device=device)
+    x_real = torch.randn((batch_size, ) + tuple(sample_shape), device=device)
+    if x_real.dim() == 4:
+        x_real = x_real.contiguous(memory_format=get_memory_format(config))
+    y = torch.zeros(batch_size, dtype=torch.int64, device=device)
+    steps = [0]
+
+    def step():
+        steps[0] += 1
+        z = zdist.sample((batch_size, ))
+        if isinstance(trainer, Trainer_pid):
+            trainer.discriminator_trainstep(x_real, y, z, steps[0])
+        else:
+            trainer.discriminator_trainstep(x_real, y, z)
+        z = zdist.sample((batch_size, ))
+        trainer.generator_trainstep(y, z)
+
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    reset_peak_memory(device)
+    try:
+        t = time_steps(step, nsteps, nwarmup=1, device=device)
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        return None
+    finally:
+        del generator, discriminator, g_optimizer, d_optimizer, trainer
+        gc.collect()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    footprint = peak_memory(device)
+    buffer_bytes = 0
+    if trainer_class is Trainer_pid:
+        buffer_bytes = integral_buffer_bytes(config, sample_shape)
+    if device.type == 'cpu':
+        footprint += buffer_bytes
+
+    return dict(batch_size=batch_size,
+                footprint=footprint,
+                integral_buffer=buffer_bytes,
+                samples_per_sec=batch_size / t)
+
+
+def build_trainer(trainer_class, generator, discriminator, g_optimizer,
+                  d_optimizer, config):
+    kwargs = dict(gan_type=config['training']['gan_type'],
+                  reg_type=config['training']['reg_type'],
+                  reg_param=config['training']['reg_param'])
+    if trainer_class is Trainer_pid:
+        kwargs.update(pv=config['training']['pv'],
+                      iv=config['training']['iv'],
+                      dv=config['training']['dv'],
+                      batch_size=config['training']['batch_size'],
+                      config=config)
+    return trainer_class(generator, discriminator, g_optimizer, d_optimizer,
+                         **kwargs)
+
+
+def integral_buffer_bytes(config, sample_shape):
+    ''' Host memory of the filled real and fake Random_queue of the PID
+    trainer (float64 samples and labels).
+    '''
+    if config['training']['iv'] <= 0:
+        return 0
+    capacity = (config['training']['batch_size'] *
+                config['training']['i_buffer_factor'])
+    return 2 * capacity * (int(np.prod(sample_shape)) + 1) * 8
+
+
+def save_batch_size(config_file, batch_size):
+    ''' Writes the chosen batch size into a saved config file. '''
+    with open(config_file, 'r') as f:
+        cfg = yaml.load(f)
+    if cfg.get('training') is None:
+        cfg['training'] = dict()
+    cfg['training']['batch_size'] = batch_size
+    with open(config_file, 'w') as f:
+        yaml.dump(cfg, f, default_flow_style=False)
@@ -1,5 +1,6 @@
 import os
 import urllib
+import zipfile
 import torch
 from torch.utils import model_zoo
 
@@ -11,10 +12,14 @@ class CheckpointIO(object):
 
     Args:
         checkpoint_dir (str): path where checkpoints are saved
+        write (bool): whether save writes files. In a distributed run all
+            ranks call save, since state_dict of sharded optimizers is
+            collective, and only one of them writes.
     '''
-    def __init__(self, checkpoint_dir='./chkpts', **kwargs):
+    def __init__(self, checkpoint_dir='./chkpts', write=True, **kwargs):
         self.module_dict = kwargs
         self.checkpoint_dir = checkpoint_dir
+        self.write = write
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
 
@@ -35,7 +40,33 @@ class CheckpointIO(object):
         outdict = kwargs
         for k, v in self.module_dict.items():
             outdict[k] = v.state_dict()
-        torch.save(outdict, filename)
+        if not self.write:
+            return
+        # Write to a temporary file first, so that a run killed while saving
+        # never leaves a truncated checkpoint behind
+        tmp_filename = filename + '.tmp'
+        torch.save(outdict, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def latest_checkpoint(self):
+        ''' Returns the newest checkpoint in checkpoint_dir that can be
+        loaded, or None if there is none.
+
+        Saves are atomic, so only files that are not complete zip archives,
+        e.g. truncated by a full disk, are skipped. The check reads the
+        central directory at the end of the file, not the tensors.
+        '''
+        filenames = [
+            os.path.join(self.checkpoint_dir, f)
+            for f in os.listdir(self.checkpoint_dir) if f.endswith('.pt')
+        ]
+        filenames.sort(key=os.path.getmtime, reverse=True)
+        for filename in filenames:
+            if not zipfile.is_zipfile(filename):
+                print('Warning: skipping corrupted checkpoint %s!' % filename)
+                continue
+            return filename
+        return None
 
     def load(self, filename):
         '''Loads a module dictionary from local file or url.
@@ -61,7 +92,8 @@ class CheckpointIO(object):
         if os.path.exists(filename):
             # print(filename)
             # print('=> Loading checkpoint from local file...')
-            state_dict = torch.load(filename)
+            # RNG states and integral buffers are not plain tensors
+            state_dict = torch.load(filename, weights_only=False)
             scalars = self.parse_state_dict(state_dict)
             return scalars
         else:
@@ -1,9 +1,12 @@
+import copy
 import yaml
-from torch import optim
+import torch
+from torch import nn, optim
 from os import path
 from gan_training.models import generator_dict, discriminator_dict
 from gan_training.train import toggle_grad
 from gan_training.pid_optimizer import PID_RMSprop
+from gan_training.utils import ModelAverageBank
 
 
 # General config
@@ -56,6 +59,17 @@ def update_recursive(dict1, dict2):
             dict1[k] = v
 
 
+def get_out_dir(config, key=''):
+    ''' Returns the output directory of train.py and train_pid.py.
+
+    Args:
+        config (dict): config dictionary
+        key (str): suffix given on the command line
+    '''
+    return "{}{}_{}_{}".format(config['training']['out_dir'], "Plot",
+                               config['training']['out_basename'], key)
+
+
 def build_models(config):
     # Get classes
     Generator = generator_dict[config['generator']['name']]
@@ -71,9 +85,50 @@ def build_models(config):
                                   size=config['data']['img_size'],
                                   **config['discriminator']['kwargs'])
 
+    # Memory format
+    memory_format = get_memory_format(config)
+    if memory_format == torch.channels_last:
+        generator = generator.to(memory_format=memory_format)
+        discriminator = discriminator.to(memory_format=memory_format)
+        generator.channels_last = True
+        discriminator.channels_last = True
+
+    # Activation checkpointing of the ResNet stacks
+    checkpoint_segments = config['training']['checkpoint_segments']
+    if checkpoint_segments > 0:
+        for model in [generator, discriminator]:
+            if not hasattr(model, 'checkpoint_segments'):
+                raise ValueError('%s does not support checkpoint_segments.' %
+                                 type(model).__module__)
+    generator.checkpoint_segments = config['training']['checkpoint_segments']
+    discriminator.checkpoint_segments = config['training'][
+        'checkpoint_segments']
+
+    # Row-sparse gradients of the label embeddings of D, only PID_RMSprop
+    # updates them
+    if config['training']['sparse_embeddings']:
+        if (config['training']['optimizer'] != 'rmsprop-pid'
+                or config['training']['optimizer-flat']):
+            raise ValueError('Sparse embeddings need the rmsprop-pid '
+                             'optimizer without optimizer-flat.')
+        for module in discriminator.modules():
+            if isinstance(module, nn.Embedding):
+                module.sparse = True
+
     return generator, discriminator
 
 
+def get_memory_format(config):
+    memory_format = config['training']['memory_format']
+    if memory_format == 'channels_last':
+        return torch.channels_last
+    elif memory_format == 'contiguous':
+        return torch.contiguous_format
+    else:
+        raise NotImplementedError('Memory format "%s" not supported!' %
+                                  memory_format)
+
+
 def build_optimizers(generator, discriminator, config):
     optimizer = config['training']['optimizer']
     lr_g = config['training']['lr_g']
@@ -116,7 +171,20 @@ def build_optimizers(generator, discriminator, config):
             vp=config['training']['optimizer-vp'],
             vi=config['training']['optimizer-vi'],
             vd=config['training']['optimizer-vd'],
+            foreach=config['training']['optimizer-foreach'],
+            flat=config['training']['optimizer-flat'],
+            state_precision=config['training']['optimizer-state-precision'],
+            integral_rounding=config['training']
+            ['optimizer-integral-rounding'],
+            offload=config['training']['optimizer-offload'],
+            offload_dir=config['training']['optimizer-offload-dir'],
         )
+        # Rows of the sparse label embeddings that skipped steps are caught
+        # up before they are looked up
+        if config['training']['sparse_embeddings']:
+            for module in discriminator.modules():
+                if isinstance(module, nn.Embedding):
+                    d_optimizer.register_catch_up(module)
     elif optimizer == 'adam':
         g_optimizer = optim.Adam(g_params, lr=lr_g, betas=(0., 0.99), eps=1e-8)
         d_optimizer = optim.Adam(d_params, lr=lr_d, betas=(0., 0.99), eps=1e-8)
@@ -127,6 +195,36 @@ def build_optimizers(generator, discriminator, config):
     return g_optimizer, d_optimizer
 
 
+def build_model_average(generator, config):
+    ''' Builds the averaged test generators.
+
+    model_average_beta is either a single beta or a list of betas. The first
+    shadow is registered as generator_test, the others as
+    generator_test_<beta>.
+
+    Args:
+        generator (nn.Module): trained generator
+        config (dict): config dictionary
+    '''
+    betas = config['training']['model_average_beta']
+    if not isinstance(betas, list):
+        betas = [betas]
+
+    generator_tests = dict()
+    for i, beta in enumerate(betas):
+        name = 'generator_test' if i == 0 else 'generator_test_%g' % beta
+        generator_tests[name] = copy.deepcopy(generator)
+
+    model_average = ModelAverageBank(
+        list(generator_tests.values()),
+        generator,
+        betas,
+        ema_every=config['training']['model_average_every'],
+        average_buffers=config['training']['model_average_buffers'])
+
+    return generator_tests, model_average
+
+
 def build_lr_scheduler(optimizer, config, last_epoch=-1):
     lr_scheduler = optim.lr_scheduler.StepLR(
         optimizer,
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+from os import path
+import numpy as np
+import torch
+
+# Bumped when the cached images would change for the same settings
+cache_version = 1
+
+# Datasets whose decoded images can be cached
+cached_datasets = ['image', 'lsun', 'lsun_class', 'cifar10']
+
+
+class ShardedArray(object):
+    ''' Read-only concatenation of memory-mapped .npy shards along the first
+    axis. Supports integer indices and contiguous slices.
+
+    Args:
+        filenames (list): shard files, in order
+    '''
+    def __init__(self, filenames):
+        self.shards = [np.load(f, mmap_mode='r') for f in filenames]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+        self.shape = (int(self.offsets[-1]), ) + self.shards[0].shape[1:]
+        self.dtype = self.shards[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += len(self)
+            shard = self.find_shard(key)
+            return self.shards[shard][key - self.offsets[shard]]
+
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise IndexError('Only contiguous slices are supported.')
+        parts = []
+        while start < stop:
+            shard = self.find_shard(start)
+            end = min(stop, self.offsets[shard + 1])
+            offset = self.offsets[shard]
+            parts.append(self.shards[shard][start - offset:end - offset])
+            start = end
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 0:
+            return np.empty((0, ) + self.shape[1:], dtype=self.dtype)
+        return np.concatenate(parts)
+
+    def find_shard(self, index):
+        return np.searchsorted(self.offsets, index, side='right') - 1
+
+
+def get_cache_dir(name, data_dir, size, lsun_categories, config):
+    ''' Returns the directory of the cached dataset, or None if caching is
+    off or not supported for the dataset.
+
+    The directory is named after a hash of the source, the size and the
+    transform, so changing any of them uses a new cache.
+    '''
+    if config is None or config['data']['cache_dir'] is None:
+        return None
+    if name not in cached_datasets:
+        return None
+    key = dict(name=name,
+               data_dir=path.abspath(data_dir),
+               lsun_categories=lsun_categories,
+               size=size,
+               transform='resize_center_crop',
+               version=cache_version)
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode())
+    return path.join(config['data']['cache_dir'],
+                     '%s_%d_%s' % (name, size, digest.hexdigest()[:16]))
+
+
+def is_cached(cache_dir):
+    # The index is written last, after all shards
+    return cache_dir is not None and path.exists(
+        path.join(cache_dir, 'index.json'))
+
+
+def load_cache(cache_dir):
+    ''' Returns the images as ShardedArray, the labels and the index of a
+    cached dataset.
+    '''
+    with open(path.join(cache_dir, 'index.json')) as f:
+        index = json.load(f)
+    imgs = ShardedArray(
+        [path.join(cache_dir, filename) for filename in index['shards']])
+    labels = np.load(path.join(cache_dir, 'labels.npy'))
+    return imgs, labels, index
+
+
+def write_cache(dataset, nlabels, cache_dir, shard_mb=1024, nworkers=0):
+    ''' Decodes a dataset of uint8 CHW tensors once and writes it to
+    cache_dir as .npy shards of about shard_mb MB, with the labels and an
+    index.
+
+    Args:
+        dataset (Dataset): dataset returning (uint8 image, label)
+        nlabels (int): number of labels of the dataset
+        cache_dir (str): output directory
+        shard_mb (int): size of one shard in MB
+        nworkers (int): number of DataLoader workers that decode images
+    '''
+    if not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    shape = tuple(dataset[0][0].shape)
+    shard_size = max(1, shard_mb * 2**20 // int(np.prod(shape)))
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=256,
+                                         num_workers=nworkers,
+                                         shuffle=False)
+
+    shards = []
+    labels = []
+    shard = np.empty((shard_size, ) + shape, dtype=np.uint8)
+    n = 0
+
+    def write_shard(n):
+        filename = 'images_%05d.npy' % len(shards)
+        tmp_filename = path.join(cache_dir, filename + '.tmp')
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, shard[:n])
+        os.replace(tmp_filename, path.join(cache_dir, filename))
+        shards.append(filename)
+
+    for x, y in loader:
+        x = x.numpy()
+        labels.append(y.numpy().astype(np.int64))
+        i = 0
+        while i < len(x):
+            m = min(len(x) - i, shard_size - n)
+            shard[n:n + m] = x[i:i + m]
+            n += m
+            i += m
+            if n == shard_size:
+                write_shard(n)
+                n = 0
+        print('Cached %d images...' % (len(shards) * shard_size + n))
+    if n > 0:
+        write_shard(n)
+
+    labels = np.concatenate(labels)
+    np.save(path.join(cache_dir, 'labels.npy'), labels)
+    index = dict(nimages=len(labels),
+                 shape=shape,
+                 nlabels=nlabels,
+                 shards=shards,
+                 version=cache_version)
+    with open(path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
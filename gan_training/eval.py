@@ -1,12 +1,22 @@
 import torch
 from torchvision import transforms
 from gan_training.metrics import inception_score
-import matplotlib
-from matplotlib import pyplot as plt
 import PIL
 import numpy as np
 
-matplotlib.use("Agg")
+# Viridis-like anchors of the landscape colour map
+landscape_colors = np.array([
+    [0.267, 0.005, 0.329],
+    [0.229, 0.322, 0.545],
+    [0.128, 0.567, 0.551],
+    [0.369, 0.789, 0.383],
+    [0.993, 0.906, 0.144],
+])
+landscape_lut = np.stack([
+    np.interp(np.linspace(0, 1, 256),
+              np.linspace(0, 1, len(landscape_colors)), c)
+    for c in landscape_colors.T
+], 1).astype(np.float32)
 
 
 class Evaluator(object):
@@ -16,13 +26,15 @@ class Evaluator(object):
                  ydist,
                  batch_size=64,
                  inception_nsamples=60000,
-                 device=None):
+                 device=None,
+                 toy_renderer='matplotlib'):
         self.generator = generator
         self.zdist = zdist
         self.ydist = ydist
         self.inception_nsamples = inception_nsamples
         self.batch_size = batch_size
         self.device = device
+        self.render_toy = toy_render_dict[toy_renderer]
 
     def compute_inception_score(self):
         self.generator.eval()
@@ -35,6 +47,31 @@ class Evaluator(object):
             samples = [s.data.cpu().numpy() for s in samples]
             imgs.extend(samples)
 
+        return self.score_samples(imgs)
+
+    def compute_inception_scores(self, generators):
+        ''' Scores several generators on the same latent codes.
+
+        Args:
+            generators (dict): generators to score, by name
+        '''
+        nbatches = -(-self.inception_nsamples // self.batch_size)
+        zs = [self.zdist.sample((self.batch_size, )) for _ in range(nbatches)]
+        ys = [self.ydist.sample((self.batch_size, )) for _ in range(nbatches)]
+
+        scores = dict()
+        for name, generator in generators.items():
+            generator.eval()
+            imgs = []
+            with torch.no_grad():
+                for ztest, ytest in zip(zs, ys):
+                    samples = generator(ztest, ytest)
+                    imgs.extend([s.cpu().numpy() for s in samples])
+            scores[name] = self.score_samples(imgs)
+
+        return scores
+
+    def score_samples(self, imgs):
         imgs = imgs[:self.inception_nsamples]
         score, score_std = inception_score(imgs,
                                            device=self.device,
@@ -65,62 +102,224 @@ class Evaluator(object):
                 x = self.generator(z, y)
             return x
         else:
-            self.generator.eval()
-            z_sample = self.zdist.sample((10000, ))
-            y_sample = self.ydist.sample((10000, ))
-            y_sample = torch.clamp(y_sample, None, 0)
-            with torch.no_grad():
-                x_fake = self.generator(z_sample, y_sample)
-
             np_samples_data = x_real.data.cpu().numpy()
-            np_samples_gen = x_fake.data.cpu().numpy()
-
-            fig = plt.figure(figsize=(5, 5))
-            plt.scatter(np_samples_data[:, 0],
-                        np_samples_data[:, 1],
-                        s=8,
-                        c='r',
-                        edgecolor='none',
-                        alpha=0.05)
-            plt.scatter(np_samples_gen[:, 0],
-                        np_samples_gen[:, 1],
-                        s=8,
-                        c='b',
-                        edgecolor='none',
-                        alpha=0.05)
-            show_range = 1.6
-            plt.xlim((-show_range, show_range))
-            plt.ylim((-show_range, show_range))
-            plt.grid(True)
-            plt.tight_layout()
-
-            canvas = plt.get_current_fig_manager().canvas
-            canvas.draw()
-            pil_image = PIL.Image.frombytes('RGB', canvas.get_width_height(),
-                                            canvas.tostring_rgb())
-            plt.close()
-            plt.close(fig)
-
-            img_tensor = transforms.ToTensor()(pil_image)
-            img_tensor = torch.unsqueeze(img_tensor, 0)
-
-            fig = plt.figure(figsize=(5, 5))
-            n = 1000
-            x = np.arange(n)
-            y = np.arange(n)
-            X, Y = np.meshgrid(x, y)
-            cp = plt.contour(X, Y, contour_matrix, 20)
-            plt.clabel(cp, inline=True, fontsize=7)
-            canvas = plt.get_current_fig_manager().canvas
-            canvas.draw()
-            pil_image = PIL.Image.frombytes('RGB', canvas.get_width_height(),
-                                            canvas.tostring_rgb())
-            plt.close()
-            plt.close(fig)
-
-            contour_tensor = transforms.ToTensor()(pil_image)
-            contour_tensor = torch.unsqueeze(contour_tensor, 0)
-
-            final_tensor = torch.cat([img_tensor, contour_tensor], 0)
-
-            return final_tensor
+            np_samples_gen = self.sample_toy()
+            return self.render_toy(np_samples_data, np_samples_gen,
+                                   contour_matrix)
+
+    def sample_toy(self, nsamples=10000):
+        self.generator.eval()
+        z_sample = self.zdist.sample((nsamples, ))
+        y_sample = self.ydist.sample((nsamples, ))
+        y_sample = torch.clamp(y_sample, None, 0)
+        with torch.no_grad():
+            x_fake = self.generator(z_sample, y_sample)
+        return x_fake.data.cpu().numpy()
+
+
+def render_toy(np_samples_data, np_samples_gen, contour_matrix):
+    ''' Renders toy samples and the D landscape as a [2, 3, H, W] tensor.
+
+    Args:
+        np_samples_data (array): real samples of shape [N, 2]
+        np_samples_gen (array): generated samples of shape [M, 2]
+        contour_matrix (array): discriminator output on a square grid
+    '''
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+
+    fig = plt.figure(figsize=(5, 5))
+    plt.scatter(np_samples_data[:, 0],
+                np_samples_data[:, 1],
+                s=8,
+                c='r',
+                edgecolor='none',
+                alpha=0.05)
+    plt.scatter(np_samples_gen[:, 0],
+                np_samples_gen[:, 1],
+                s=8,
+                c='b',
+                edgecolor='none',
+                alpha=0.05)
+    show_range = 1.6
+    plt.xlim((-show_range, show_range))
+    plt.ylim((-show_range, show_range))
+    plt.grid(True)
+    plt.tight_layout()
+
+    canvas = plt.get_current_fig_manager().canvas
+    canvas.draw()
+    pil_image = PIL.Image.frombytes('RGB', canvas.get_width_height(),
+                                    canvas.tostring_rgb())
+    plt.close()
+    plt.close(fig)
+
+    img_tensor = transforms.ToTensor()(pil_image)
+    img_tensor = torch.unsqueeze(img_tensor, 0)
+
+    fig = plt.figure(figsize=(5, 5))
+    n = contour_matrix.shape[0]
+    x = np.arange(n)
+    y = np.arange(n)
+    X, Y = np.meshgrid(x, y)
+    cp = plt.contour(X, Y, contour_matrix, 20)
+    plt.clabel(cp, inline=True, fontsize=7)
+    canvas = plt.get_current_fig_manager().canvas
+    canvas.draw()
+    pil_image = PIL.Image.frombytes('RGB', canvas.get_width_height(),
+                                    canvas.tostring_rgb())
+    plt.close()
+    plt.close(fig)
+
+    contour_tensor = transforms.ToTensor()(pil_image)
+    contour_tensor = torch.unsqueeze(contour_tensor, 0)
+
+    final_tensor = torch.cat([img_tensor, contour_tensor], 0)
+
+    return final_tensor
+
+
+def render_toy_raster(np_samples_data,
+                      np_samples_gen,
+                      contour_matrix,
+                      resolution=500,
+                      show_range=1.6,
+                      nlevels=20):
+    ''' Rasterizes toy samples and the D landscape without matplotlib.
+
+    Real (red) and generated (blue) points are binned into log-scaled
+    densities on a fixed grid, the landscape is colour-mapped with a lookup
+    table and overlaid with nlevels iso-lines. Returns the same [2, 3, H, W]
+    tensor as render_toy.
+
+    Args:
+        np_samples_data (array): real samples of shape [N, 2]
+        np_samples_gen (array): generated samples of shape [M, 2]
+        contour_matrix (array): discriminator output on a square grid
+        resolution (int): height and width of both panels
+        show_range (float): half width of the shown sample range
+        nlevels (int): number of iso-lines of the landscape
+    '''
+    def density(samples):
+        hist, _, _ = np.histogram2d(samples[:, 0],
+                                    samples[:, 1],
+                                    bins=resolution,
+                                    range=[[-show_range, show_range]] * 2)
+        hist = np.log1p(hist)
+        hist = hist / max(hist.max(), 1e-8)
+        # x to the right, y upwards
+        return np.flipud(hist.T)
+
+    d_real = density(np_samples_data)
+    d_gen = density(np_samples_gen)
+    img = np.stack([
+        1. - d_gen,
+        1. - np.clip(d_real + d_gen, 0., 1.),
+        1. - d_real,
+    ], 0)
+
+    n = contour_matrix.shape[0]
+    index = np.arange(resolution) * n // resolution
+    matrix = np.flipud(contour_matrix[index][:, index])
+    low, high = matrix.min(), matrix.max()
+    matrix = (matrix - low) / max(high - low, 1e-8)
+    contour = landscape_lut[(matrix * 255).astype(np.int64)]
+
+    levels = np.minimum((matrix * nlevels).astype(np.int64), nlevels - 1)
+    lines = np.zeros(levels.shape, dtype=bool)
+    lines[1:] |= levels[1:] != levels[:-1]
+    lines[:, 1:] |= levels[:, 1:] != levels[:, :-1]
+    contour[lines] = 0.
+    contour = contour.transpose([2, 0, 1])
+
+    final_tensor = torch.from_numpy(
+        np.stack([img, contour], 0).astype(np.float32))
+
+    return final_tensor
+
+
+toy_render_dict = {
+    'matplotlib': render_toy,
+    'raster': render_toy_raster,
+}
+
+
+class LandscapeEvaluator(object):
+    ''' Evaluates a 2D discriminator on a fixed square grid.
+
+    The grid is built once and pushed through the discriminator in chunks
+    without gradients. A stride > 1 evaluates every stride-th grid point
+    along each axis, for cheap coarse snapshots of the same landscape.
+
+    Args:
+        grid_range (list): lower and upper bound of both axes
+        resolution (int): number of grid points per axis
+        chunk_size (int): number of points per discriminator call
+        device (device): device to evaluate on
+    '''
+    def __init__(self,
+                 grid_range=(-1.6, 1.6),
+                 resolution=1000,
+                 chunk_size=65536,
+                 device=None):
+        self.resolution = resolution
+        self.chunk_size = chunk_size
+        self.device = device
+
+        axis = torch.arange(resolution, dtype=torch.float32, device=device)
+        axis = (grid_range[1] -
+                grid_range[0]) / resolution * axis + grid_range[0]
+        grid_x, grid_y = torch.meshgrid(axis, axis, indexing='ij')
+        self.grid = torch.stack([grid_x, grid_y], dim=-1)
+
+    def evaluate(self, discriminator, stride=1):
+        ''' Returns the discriminator output as a [n, n] matrix.
+
+        Args:
+            discriminator (nn.Module): discriminator to evaluate
+            stride (int): evaluate every stride-th grid point per axis
+        '''
+        grid = self.grid[::stride, ::stride]
+        n = grid.size(0)
+        grid = grid.reshape(-1, 2)
+
+        outputs = []
+        with torch.no_grad():
+            for x in grid.split(self.chunk_size):
+                y = torch.zeros(x.size(0),
+                                dtype=torch.int64,
+                                device=self.device)
+                outputs.append(discriminator(x, y).view(-1))
+
+        return torch.cat(outputs).cpu().numpy().reshape([n, n])
+
+
+def mixture_mode_stats(samples, centers, std, threshold=3.):
+    ''' Mode coverage of samples from a mixture of Gaussians.
+
+    A sample is of high quality if it lies within threshold standard
+    deviations of its closest center, and a mode is covered if at least one
+    high quality sample falls into it.
+
+    Args:
+        samples (Tensor): samples of shape [..., N, 2]
+        centers (array): mixture centers of shape [M, 2]
+        std (float): standard deviation of the mixture components
+        threshold (float): acceptance radius in standard deviations
+    '''
+    centers = torch.as_tensor(centers,
+                              dtype=samples.dtype,
+                              device=samples.device)
+    centers = centers.expand(samples.shape[:-2] + centers.shape)
+    dist, closest = torch.cdist(samples, centers).min(dim=-1)
+    high_quality = dist < threshold * std
+
+    hits = torch.zeros(samples.shape[:-2] + (centers.size(-2), ),
+                       dtype=samples.dtype,
+                       device=samples.device)
+    hits.scatter_add_(-1, closest, high_quality.to(samples.dtype))
+    covered = (hits > 0).float().sum(-1)
+    hq_ratio = high_quality.float().mean(-1)
+
+    return covered, hq_ratio
@@ -1,16 +1,29 @@
+import random
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import numpy as np
 import PIL.Image
+from gan_training.data_cache import get_cache_dir, is_cached, load_cache
 
 
 class NumpyImageDataset(Dataset):
-    def __init__(self, imgs, label, transform=None):
+    ''' Images in a uint8 array of shape (N, C, H, W), e.g. a memory-mapped
+    .npy file.
+
+    Args:
+        imgs (array): images
+        label (array): labels
+        transform (callable): transform of PIL images
+        tensor_transform (callable): transform of uint8 CHW tensors, used
+            instead of transform if given
+    '''
+    def __init__(self, imgs, label, transform=None, tensor_transform=None):
         self.imgs = imgs
         self.label = label
         self.transform = transform
+        self.tensor_transform = tensor_transform
 
         self.num_classes = np.unique(label).shape[0]
 
@@ -18,9 +31,20 @@ class NumpyImageDataset(Dataset):
         return len(self.imgs)
 
     def __getitem__(self, index):
-        img = np.array(self.imgs[index])
-        label = self.label[index]
-        # print(img.shape)
+        return self.get_sample((np.array(self.imgs[index]), self.label[index]))
+
+    def __getitems__(self, indices):
+        return [self.get_sample(item) for item in self.read_batch(indices)]
+
+    def read_batch(self, indices):
+        ''' Reads the images and labels of a batch, see read_rows. '''
+        imgs = read_rows(self.imgs, indices)
+        return [(img, self.label[index]) for img, index in zip(imgs, indices)]
+
+    def get_sample(self, item):
+        img, label = item
+        if self.tensor_transform is not None:
+            return self.tensor_transform(torch.from_numpy(img)), label
 
         img = img.transpose([1, 2, 0])
         img = PIL.Image.fromarray(img)
@@ -65,34 +89,315 @@ class MixtureOfGaussianDataset(Dataset):
 
     def __getitem__(self, index):
         if self.shape == "circle":
-            sample = np.random.normal(0, 1, 2)
+            sample = self.rng.normal(0, 1, 2)
             sample = sample / (np.sqrt(sample[1]**2 + sample[0]**2))
         else:
-            index = np.random.randint(0, self.num_mixture)
+            index = self.rng.randint(0, self.num_mixture)
             center = self.centers[index]
             sample = self.rng.normal(size=center.shape) * self.std + center
             # print(sample, type(sample), sample.dtype, sample.shape)
         sample = torch.from_numpy(sample.astype(np.float32))
         return sample, torch.from_numpy(np.array([0]))
 
+    def sample_batch(self, n, generator=None, device=None):
+        ''' Draws n samples and labels at once, with the distribution of
+        __getitem__.
+
+        Args:
+            n (int): number of samples
+            generator (Generator): torch generator on device
+            device (device): device of the samples
+        '''
+        noise = torch.randn((n, 2), generator=generator, device=device)
+        if self.shape == "circle":
+            sample = noise / noise.norm(dim=1, keepdim=True)
+        else:
+            centers = torch.as_tensor(self.centers,
+                                      dtype=torch.float32,
+                                      device=device)
+            index = torch.randint(self.num_mixture, (n, ),
+                                  generator=generator,
+                                  device=device)
+            sample = noise.mul_(self.std).add_(centers[index])
+        return sample, torch.zeros((n, 1), dtype=torch.int64, device=device)
+
+
+class MixtureOfGaussianLoader(object):
+    ''' Loader that draws every batch of a MixtureOfGaussianDataset in one
+    vectorized call on the device, without DataLoader and collation.
+
+    The stream of batches is infinite, an epoch is the number of full
+    batches in the dataset as with a DataLoader.
+
+    Args:
+        dataset (MixtureOfGaussianDataset): dataset to sample from
+        batch_size (int): batch size
+        device (device): device of the batches
+        seed (int): seed of the generator
+    '''
+    def __init__(self, dataset, batch_size, device=None, seed=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield self.dataset.sample_batch(self.batch_size, self.generator,
+                                            self.device)
+
+    def __len__(self):
+        return len(self.dataset) // self.batch_size
+
+
+class ResumableSampler(Sampler):
+    ''' Random sampler that can start in the middle of an epoch.
+
+    The order of every epoch only depends on seed and epoch, so a resumed run
+    can jump to the batch it stopped at with set_epoch. Every index comes
+    with its own seed for SeededDataset, which makes random transforms
+    independent of the number of workers and of the resume position.
+
+    Args:
+        data_source (Dataset): dataset to sample from
+        seed (int): seed of the data order
+    '''
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        ''' Selects the epoch and the first sample to yield.
+
+        Args:
+            epoch (int): epoch index
+            start (int): number of samples of the epoch to skip
+        '''
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed * 1000003 + self.epoch)
+        n = len(self.data_source)
+        permutation = torch.randperm(n, generator=g)
+        seeds = torch.randint(2**31, (n, ), generator=g)
+        for i in range(self.start, n):
+            yield permutation[i].item(), seeds[i].item()
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+class SeededDataset(Dataset):
+    ''' Loads every sample of a ResumableSampler with its own seed.
+
+    The torch, NumPy and Python random streams (and the rng of datasets
+    that have one, like MixtureOfGaussianDataset) are seeded before the
+    sample is loaded. In the main process, i.e. without workers, the
+    previous random states are restored afterwards.
+
+    Args:
+        dataset (Dataset): wrapped dataset
+    '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        index, seed = key
+        return self.seeded(seed, self.dataset.__getitem__, index)
 
-def get_dataset(name, data_dir, size=64, lsun_categories=None, config=None):
-    transform = transforms.Compose([
-        transforms.Resize(size),
-        transforms.CenterCrop(size),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        transforms.Lambda(lambda x: x + 1. / 128 * torch.rand(x.size())),
-    ])
+    def __getitems__(self, keys):
+        ''' Loads a batch. Datasets with read_batch read it at once, the
+        random transforms are still seeded per sample.
+        '''
+        if not hasattr(self.dataset, 'read_batch'):
+            return [self[key] for key in keys]
+        items = self.dataset.read_batch([index for index, _ in keys])
+        return [
+            self.seeded(seed, self.dataset.get_sample, item)
+            for item, (_, seed) in zip(items, keys)
+        ]
+
+    def seeded(self, seed, fn, *args):
+        if torch.utils.data.get_worker_info() is not None:
+            self.reseed(seed)
+            return fn(*args)
+
+        np_state = np.random.get_state()
+        random_state = random.getstate()
+        rng_state = getattr(self.dataset, 'rng', None)
+        if rng_state is not None:
+            rng_state = rng_state.get_state()
+        with torch.random.fork_rng(devices=[]):
+            self.reseed(seed)
+            sample = fn(*args)
+        np.random.set_state(np_state)
+        random.setstate(random_state)
+        if rng_state is not None:
+            self.dataset.rng.set_state(rng_state)
+        return sample
+
+    def reseed(self, seed):
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
+        if hasattr(self.dataset, 'rng'):
+            self.dataset.rng.seed(seed)
+
+
+class BatchAugment(object):
+    ''' Flip, normalization and dequantization noise of get_dataset, applied
+    to a whole uint8 batch on the training device.
+
+    With data.batch_augment the workers only resize and crop, and emit
+    uint8 images, which are a quarter of the size of float images.
+
+    Args:
+        flip (bool): whether to flip images horizontally with probability 0.5
+    '''
+    def __init__(self, flip=True):
+        self.flip = flip
+
+    def __call__(self, x):
+        if self.flip:
+            flip = torch.rand(x.size(0), device=x.device) < 0.5
+            x = torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+        x = x.float().div_(255.).sub_(0.5).div_(0.5)
+        return x.add_(torch.rand_like(x), alpha=1. / 128)
+
+
+class InMemoryLoader(object):
+    ''' Loader over a dataset held as one uint8 tensor on the device.
+
+    Batches are drawn by index permutation in the same order as
+    ResumableSampler, so it also replaces the sampler: set_epoch starts an
+    epoch in the middle. The last incomplete batch is dropped. Samples are
+    not augmented, see BatchAugment.
+
+    Args:
+        dataset (Dataset): dataset of uint8 images
+        batch_size (int): batch size
+        device (device): device the dataset is kept on
+        seed (int): seed of the data order
+        nworkers (int): DataLoader workers for the one-time load
+    '''
+    def __init__(self, dataset, batch_size, device, seed=0, nworkers=0):
+        self.imgs, self.labels = load_all(dataset, nworkers)
+        self.imgs = self.imgs.to(device)
+        self.labels = self.labels.to(device)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        print('Loaded %d images (%.1f MB) to %s.' %
+              (len(self.imgs), self.imgs.numel() / 2**20, device))
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed * 1000003 + self.epoch)
+        n = len(self.imgs)
+        permutation = torch.randperm(n, generator=g).to(self.imgs.device)
+        for i in range(self.start, n - self.batch_size + 1, self.batch_size):
+            index = permutation[i:i + self.batch_size]
+            yield self.imgs[index], self.labels[index]
+
+    def __len__(self):
+        return (len(self.imgs) - self.start) // self.batch_size
+
+
+def load_all(dataset, nworkers=0):
+    ''' Returns all images and labels of a dataset of uint8 images as two
+    tensors. Arrays that need no per-sample transform are copied at once.
+    '''
+    if (isinstance(dataset, NumpyImageDataset)
+            and dataset.tensor_transform is not None):
+        imgs = torch.from_numpy(np.ascontiguousarray(dataset.imgs[:]))
+        imgs = dataset.tensor_transform(imgs)
+        return imgs, torch.as_tensor(np.asarray(dataset.label))
+
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=256,
+                                         num_workers=nworkers,
+                                         shuffle=False)
+    imgs, labels = [], []
+    for x, y in loader:
+        imgs.append(x)
+        labels.append(y)
+    return torch.cat(imgs), torch.cat(labels)
+
+
+def get_batch_augment(config):
+    ''' Returns the BatchAugment of the config, or None if the samples are
+    augmented in the workers.
+    '''
+    if config['data']['batch_augment'] or config['data']['in_memory']:
+        return BatchAugment()
+    return None
+
+
+def get_dataset(name,
+                data_dir,
+                size=64,
+                lsun_categories=None,
+                config=None,
+                use_cache=True):
+    if config is not None and (config['data']['batch_augment']
+                               or config['data']['in_memory']):
+        if name in ['MoG', 'npy']:
+            raise ValueError('Batch augmentation needs uint8 images.')
+        # The rest is done by BatchAugment
+        transform = transforms.Compose([
+            transforms.Resize(size),
+            transforms.CenterCrop(size),
+            transforms.PILToTensor(),
+        ])
+        tensor_transform = transforms.Compose([])
+    else:
+        transform = transforms.Compose([
+            transforms.Resize(size),
+            transforms.CenterCrop(size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            transforms.Lambda(lambda x: x + 1. / 128 * torch.rand(x.size())),
+        ])
+
+        # The same transform for uint8 CHW tensors that already have the size
+        tensor_transform = transforms.Compose([
+            transforms.RandomHorizontalFlip(),
+            transforms.ConvertImageDtype(torch.float),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            transforms.Lambda(lambda x: x + 1. / 128 * torch.rand(x.size())),
+        ])
+
+    # Images decoded, resized and cropped once by preprocess_dataset.py
+    cache_dir = get_cache_dir(name, data_dir, size, lsun_categories, config)
+    if use_cache and is_cached(cache_dir):
+        imgs, labels, index = load_cache(cache_dir)
+        dataset = NumpyImageDataset(imgs, labels, transform, tensor_transform)
+        return dataset, index['nlabels']
 
     if name == "MoG":
         dataset = MixtureOfGaussianDataset(config)
         nlabels = 1
     elif name.lower() == "celeba":
-        imgs = np.load("/home/LargeData/celebA_64x64.npy")
+        # Pages are read on demand and shared by all workers
+        imgs = np.load("/home/LargeData/celebA_64x64.npy", mmap_mode='r')
         labels = np.zeros([imgs.shape[0]]).astype(np.int64)
-        dataset = NumpyImageDataset(imgs, labels, transform)
+        if imgs.shape[2:] != (size, size):
+            tensor_transform = None
+        dataset = NumpyImageDataset(imgs, labels, transform, tensor_transform)
         nlabels = 1
     elif name == 'image':
         dataset = datasets.ImageFolder(data_dir, transform)
@@ -123,6 +428,25 @@ def get_dataset(name, data_dir, size=64, lsun_categories=None, config=None):
     return dataset, nlabels
 
 
+def read_rows(array, indices):
+    ''' Returns a copy of array[indices], read with one slice per run of
+    consecutive indices. This keeps reads of memory-mapped arrays
+    sequential.
+    '''
+    indices = np.asarray(indices)
+    order = np.argsort(indices, kind='stable')
+    sorted_indices = indices[order]
+    breaks = np.flatnonzero(np.diff(sorted_indices) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(indices)]])
+
+    out = np.empty((len(indices), ) + array.shape[1:], dtype=array.dtype)
+    for start, end in zip(starts, ends):
+        first = sorted_indices[start]
+        out[order[start:end]] = array[first:first + end - start]
+    return out
+
+
 def npy_loader(path):
     img = np.load(path)
 
@@ -92,3 +92,11 @@ class Logger(object):
                 self.stats = pickle.load(f)
         except EOFError:
             print('Warning: log file corrupted!')
+
+    def truncate_stats(self, it):
+        ''' Drops the stats logged after iteration it, e.g. when resuming
+        from a checkpoint older than the stats file.
+        '''
+        for category in self.stats.values():
+            for k, values in category.items():
+                category[k] = [(i, v) for i, v in values if i <= it]
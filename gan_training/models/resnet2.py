@@ -4,9 +4,15 @@ from torch.nn import functional as F
 from torch.autograd import Variable
 import torch.utils.data
 import torch.utils.data.distributed
+from gan_training.ops import checkpoint_stages
 
 
 class Generator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self, z_dim, nlabels, size, embed_size=256, nfilter=64, **kwargs):
         super().__init__()
         s0 = self.s0 = size // 32
@@ -51,29 +57,28 @@ class Generator(nn.Module):
         yz = torch.cat([z, yembed], dim=1)
         out = self.fc(yz)
         out = out.view(batch_size, 16*self.nf, self.s0, self.s0)
-
-        out = self.resnet_0_0(out)
-        out = self.resnet_0_1(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_1_0(out)
-        out = self.resnet_1_1(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_2_0(out)
-        out = self.resnet_2_1(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_3_0(out)
-        out = self.resnet_3_1(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_4_0(out)
-        out = self.resnet_4_1(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_5_0(out)
-        out = self.resnet_5_1(out)
+        if self.channels_last:
+            out = out.contiguous(memory_format=torch.channels_last)
+
+        out = checkpoint_stages([
+            self.resnet_0_0,
+            self.resnet_0_1,
+            upsample,
+            self.resnet_1_0,
+            self.resnet_1_1,
+            upsample,
+            self.resnet_2_0,
+            self.resnet_2_1,
+            upsample,
+            self.resnet_3_0,
+            self.resnet_3_1,
+            upsample,
+            self.resnet_4_0,
+            self.resnet_4_1,
+            upsample,
+            self.resnet_5_0,
+            self.resnet_5_1,
+        ], out, self.checkpoint_segments)
 
         out = self.conv_img(actvn(out))
         out = torch.tanh(out)
@@ -82,6 +87,11 @@ class Generator(nn.Module):
 
 
 class Discriminator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self, z_dim, nlabels, size, embed_size=256, nfilter=64, **kwargs):
         super().__init__()
         self.embed_size = embed_size
@@ -119,29 +129,29 @@ class Discriminator(nn.Module):
 
         out = self.conv_img(x)
 
-        out = self.resnet_0_0(out)
-        out = self.resnet_0_1(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_1_0(out)
-        out = self.resnet_1_1(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_2_0(out)
-        out = self.resnet_2_1(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_3_0(out)
-        out = self.resnet_3_1(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_4_0(out)
-        out = self.resnet_4_1(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_5_0(out)
-        out = self.resnet_5_1(out)
-
+        out = checkpoint_stages([
+            self.resnet_0_0,
+            self.resnet_0_1,
+            downsample,
+            self.resnet_1_0,
+            self.resnet_1_1,
+            downsample,
+            self.resnet_2_0,
+            self.resnet_2_1,
+            downsample,
+            self.resnet_3_0,
+            self.resnet_3_1,
+            downsample,
+            self.resnet_4_0,
+            self.resnet_4_1,
+            downsample,
+            self.resnet_5_0,
+            self.resnet_5_1,
+        ], out, self.checkpoint_segments)
+
+        if self.channels_last:
+            # Flattening NHWC features in NCHW order needs one explicit copy
+            out = out.contiguous()
         out = out.view(batch_size, 16*self.nf*self.s0*self.s0)
         out = self.fc(actvn(out))
 
@@ -189,6 +199,14 @@ class ResnetBlock(nn.Module):
         return x_s
 
 
+def upsample(x):
+    return F.interpolate(x, scale_factor=2)
+
+
+def downsample(x):
+    return F.avg_pool2d(x, 3, stride=2, padding=1)
+
+
 def actvn(x):
     out = F.leaky_relu(x, 2e-1)
     return out
@@ -4,9 +4,15 @@ from torch.nn import functional as F
 from torch.autograd import Variable
 import torch.utils.data
 import torch.utils.data.distributed
+from gan_training.ops import checkpoint_stages
 
 
 class Generator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self, z_dim, nlabels, size, embed_size=256, nfilter=64, **kwargs):
         super().__init__()
         s0 = self.s0 = size // 64
@@ -35,26 +41,24 @@ class Generator(nn.Module):
         yz = torch.cat([z, yembed], dim=1)
         out = self.fc(yz)
         out = out.view(batch_size, 16*self.nf, self.s0, self.s0)
-
-        out = self.resnet_0_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_1_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_2_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_3_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_4_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_5_0(out)
-
-        out = F.interpolate(out, scale_factor=2)
-        out = self.resnet_6_0(out)
+        if self.channels_last:
+            out = out.contiguous(memory_format=torch.channels_last)
+
+        out = checkpoint_stages([
+            self.resnet_0_0,
+            upsample,
+            self.resnet_1_0,
+            upsample,
+            self.resnet_2_0,
+            upsample,
+            self.resnet_3_0,
+            upsample,
+            self.resnet_4_0,
+            upsample,
+            self.resnet_5_0,
+            upsample,
+            self.resnet_6_0,
+        ], out, self.checkpoint_segments)
         out = self.conv_img(actvn(out))
         out = torch.tanh(out)
 
@@ -62,6 +66,11 @@ class Generator(nn.Module):
 
 
 class Discriminator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self, z_dim, nlabels, size, embed_size=256, nfilter=64, **kwargs):
         super().__init__()
         self.embed_size = embed_size
@@ -86,26 +95,25 @@ class Discriminator(nn.Module):
         batch_size = x.size(0)
 
         out = self.conv_img(x)
-        out = self.resnet_0_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_1_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_2_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_3_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_4_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_5_0(out)
-
-        out = F.avg_pool2d(out, 3, stride=2, padding=1)
-        out = self.resnet_6_0(out)
-
+        out = checkpoint_stages([
+            self.resnet_0_0,
+            downsample,
+            self.resnet_1_0,
+            downsample,
+            self.resnet_2_0,
+            downsample,
+            self.resnet_3_0,
+            downsample,
+            self.resnet_4_0,
+            downsample,
+            self.resnet_5_0,
+            downsample,
+            self.resnet_6_0,
+        ], out, self.checkpoint_segments)
+
+        if self.channels_last:
+            # Flattening NHWC features in NCHW order needs one explicit copy
+            out = out.contiguous()
         out = out.view(batch_size, 16*self.nf*self.s0*self.s0)
         out = self.fc(actvn(out))
 
@@ -152,6 +160,14 @@ class ResnetBlock(nn.Module):
         return x_s
 
 
+def upsample(x):
+    return F.interpolate(x, scale_factor=2)
+
+
+def downsample(x):
+    return F.avg_pool2d(x, 3, stride=2, padding=1)
+
+
 def actvn(x):
     out = F.leaky_relu(x, 2e-1)
     return out
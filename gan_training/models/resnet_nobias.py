@@ -5,9 +5,15 @@ from torch.autograd import Variable
 import torch.utils.data
 import torch.utils.data.distributed
 import numpy as np
+from gan_training.ops import checkpoint_sequential
 
 
 class Generator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self,
                  z_dim,
                  nlabels,
@@ -57,8 +63,11 @@ class Generator(nn.Module):
         yz = torch.cat([z, yembed], dim=1)
         out = self.fc(yz)
         out = out.view(batch_size, self.nf0, self.s0, self.s0)
+        if self.channels_last:
+            out = out.contiguous(memory_format=torch.channels_last)
 
-        out = self.resnet(out)
+        out = checkpoint_sequential(self.resnet, out,
+                                    self.checkpoint_segments)
 
         out = self.conv_img(actvn(out))
         out = torch.tanh(out)
@@ -67,6 +76,11 @@ class Generator(nn.Module):
 
 
 class Discriminator(nn.Module):
+    # Set by build_models for training.memory_format: channels_last
+    channels_last = False
+    # Set by build_models for training.checkpoint_segments
+    checkpoint_segments = 0
+
     def __init__(self,
                  z_dim,
                  nlabels,
@@ -103,7 +117,11 @@ class Discriminator(nn.Module):
         batch_size = x.size(0)
 
         out = self.conv_img(x)
-        out = self.resnet(out)
+        out = checkpoint_sequential(self.resnet, out,
+                                    self.checkpoint_segments)
+        if self.channels_last:
+            # Flattening NHWC features in NCHW order needs one explicit copy
+            out = out.contiguous()
         out = out.view(batch_size, self.nf0 * self.s0 * self.s0)
         out = self.fc(actvn(out))
 
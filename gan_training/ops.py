@@ -1,6 +1,7 @@
 from torch import nn
 import torch
 from torch.nn import Parameter
+from torch.utils import checkpoint
 
 
 class SpectralNorm(nn.Module):
@@ -125,3 +126,47 @@ class CInstanceNorm(nn.Module):
         out = alpha * out + beta
 
         return out
+
+
+def checkpoint_sequential(sequential, x, segments):
+    ''' Runs an nn.Sequential, checkpointing it in segments when training.
+
+    Activations inside each segment are recomputed during backward instead
+    of being stored. Without gradients, or with segments <= 0, the stack is
+    run as usual.
+    '''
+    if segments <= 0 or not torch.is_grad_enabled():
+        return sequential(x)
+    segments = min(segments, len(sequential))
+    return checkpoint.checkpoint_sequential(sequential,
+                                            segments,
+                                            x,
+                                            use_reentrant=False)
+
+
+def checkpoint_stages(stages, x, segments):
+    ''' Runs a list of modules and functions in order, checkpointing them in
+    segments when training, like checkpoint_sequential. For models whose
+    blocks are not in an nn.Sequential.
+    '''
+    if segments <= 0 or not torch.is_grad_enabled():
+        for stage in stages:
+            x = stage(x)
+        return x
+    segments = min(segments, len(stages))
+    segment_size = (len(stages) + segments - 1) // segments
+
+    def run_segment(segment):
+        def run(x):
+            for stage in segment:
+                x = stage(x)
+            return x
+
+        return run
+
+    for start in range(0, len(stages), segment_size):
+        x = checkpoint.checkpoint(run_segment(stages[start:start +
+                                                     segment_size]),
+                                  x,
+                                  use_reentrant=False)
+    return x
@@ -1,6 +1,20 @@
+import contextlib
+import os
+import shutil
+import tempfile
 import torch
+import torch.distributed as dist
 from torch.optim.optimizer import Optimizer
 
+# State tensors that are kept in host memory when offloading
+offload_keys = ['square_avg', 'grad_avg', 'i_buffer', 'i_buffer_comp']
+
+# Storage dtypes of the optimizer state, None keeps the parameter dtype
+state_dtypes = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+}
+
 
 class PID_RMSprop(Optimizer):
     def __init__(self,
@@ -11,13 +25,33 @@ class PID_RMSprop(Optimizer):
                  vp=0.,
                  vi=0.,
                  vd=0.,
-                 centered=False):
+                 centered=False,
+                 foreach=False,
+                 flat=False,
+                 state_precision='fp32',
+                 integral_rounding='kahan',
+                 offload=None,
+                 offload_dir=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {}".format(eps))
         if not 0.0 <= alpha:
             raise ValueError("Invalid alpha value: {}".format(alpha))
+        if state_precision not in state_dtypes:
+            raise ValueError(
+                "Invalid state precision: {}".format(state_precision))
+        if integral_rounding not in ['kahan', 'stochastic', 'nearest']:
+            raise ValueError(
+                "Invalid integral rounding: {}".format(integral_rounding))
+        if foreach and not flat and state_precision != 'fp32':
+            raise ValueError("The foreach step only supports fp32 state.")
+        if offload not in [None, 'pinned', 'mmap']:
+            raise ValueError("Invalid offload mode: {}".format(offload))
+        if offload is not None and (flat or foreach):
+            raise ValueError("Offloading needs the per-parameter step.")
+        if offload == 'mmap' and offload_dir is None:
+            raise ValueError("Offloading to mmap files needs offload_dir.")
 
         defaults = dict(lr=lr,
                         alpha=alpha,
@@ -25,13 +59,100 @@ class PID_RMSprop(Optimizer):
                         centered=centered,
                         vp=vp,
                         vi=vi,
-                        vd=vd)
+                        vd=vd,
+                        foreach=foreach)
         super(PID_RMSprop, self).__init__(params, defaults)
 
+        # With flat=True the parameters, gradients and state of every group
+        # live in single contiguous buffers, see flatten_group
+        self.flat = flat
+        self.flat_groups = dict()
+
+        # Storage of square_avg, grad_avg and i_buffer, the math is done in
+        # the precision of the parameters
+        self.state_precision = state_precision
+        self.state_dtype = state_dtypes[state_precision]
+        self.integral_rounding = integral_rounding
+        self.generators = dict()
+
+        # State kept in host memory and streamed in during step
+        self.offload = offload
+        self.offload_dir = offload_dir
+        self.offload_subdir = None
+        self.copy_streams = dict()
+        if offload == 'mmap' and not os.path.exists(offload_dir):
+            os.makedirs(offload_dir)
+
     def __setstate__(self, state):
         super(PID_RMSprop, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('centered', False)
+            group.setdefault('foreach', False)
+        self.__dict__.setdefault('flat', False)
+        self.__dict__.setdefault('flat_groups', dict())
+        self.__dict__.setdefault('state_precision', 'fp32')
+        self.__dict__.setdefault('state_dtype', None)
+        self.__dict__.setdefault('integral_rounding', 'kahan')
+        self.__dict__.setdefault('generators', dict())
+        self.__dict__.setdefault('offload', None)
+        self.__dict__.setdefault('offload_dir', None)
+        self.__dict__.setdefault('offload_subdir', None)
+        self.__dict__.setdefault('copy_streams', dict())
+
+    def __del__(self):
+        # The mmap files are only valid for the lifetime of the optimizer
+        offload_subdir = self.__dict__.get('offload_subdir')
+        if offload_subdir is not None:
+            shutil.rmtree(offload_subdir, ignore_errors=True)
+
+    def load_state_dict(self, state_dict):
+        super(PID_RMSprop, self).load_state_dict(state_dict)
+        # The loaded per-parameter state is flattened again at the next step
+        for flat_group in self.flat_groups.values():
+            for hook in flat_group['hooks']:
+                hook.remove()
+        self.flat_groups = dict()
+
+        # Checkpoints of any state precision are converted to this one
+        index = -1
+        for group in self.param_groups:
+            for p in group['params']:
+                index += 1
+                state = self.state[p]
+                dtype = self.state_dtype or p.dtype
+                kahan = (dtype != p.dtype
+                         and self.integral_rounding == 'kahan')
+                if 'i_buffer_comp' in state and not kahan:
+                    state['i_buffer'] = state['i_buffer'].to(p.dtype).add_(
+                        state.pop('i_buffer_comp'))
+                for key in ['square_avg', 'grad_avg', 'i_buffer']:
+                    if key in state:
+                        state[key] = state[key].to(dtype)
+                if 'i_buffer' in state and kahan:
+                    if 'i_buffer_comp' not in state:
+                        state['i_buffer_comp'] = torch.zeros_like(
+                            state['i_buffer'])
+                    state['i_buffer_comp'] = state['i_buffer_comp'].to(dtype)
+                if self.offload is not None:
+                    self.offload_state(state, index)
+
+    def zero_grad(self, set_to_none=True):
+        if not self.flat:
+            return super(PID_RMSprop, self).zero_grad(set_to_none)
+        # Flat gradients are zeroed in place, so that backward keeps
+        # accumulating into the views of the flat buffer. As in the loop, a
+        # zeroed gradient still counts as one unless it was set to None.
+        for index, group in enumerate(self.param_groups):
+            flat_group = self.flat_groups.get(index)
+            if flat_group is not None:
+                flat_group['grad'].zero_()
+                flat_group['has_grad'][:] = [
+                    not set_to_none and p.requires_grad
+                    for p in group['params']
+                ]
+                continue
+            for p in group['params']:
+                p.grad = None
 
     def step(self, closure=None):
 
@@ -39,63 +160,918 @@ class PID_RMSprop(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        for index, group in enumerate(self.param_groups):
+            if self.flat:
+                self.flat_step(index, group)
+                continue
+
+            if group['foreach']:
+                self.foreach_step(group)
+                continue
+
+            if self.offload is not None:
+                self.offload_step(group)
+                continue
+
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError(
-                        'RMSprop does not support sparse gradients')
+                self.param_step(p, self.state[p], group)
+
+        return loss
+
+    def param_step(self, p, state, group):
+        grad = p.grad.data
+        if grad.is_sparse:
+            return self.sparse_step(p, state, group)
+
+        alpha = group['alpha']
+        vp = group['vp']
+        vi = group['vi']
+        vd = group['vd']
+
+        # State initialization
+        if len(state) == 0:
+            self.init_state(state, p, group)
+
+        # Dense gradient of a parameter that had sparse ones before
+        if 'row_step' in state:
+            rows = torch.arange(p.size(0), device=p.device)
+            self.catch_up_rows(p, state, group, rows, state['step'])
+            del state['row_step']
+
+        square_avg = self.update_average(state['square_avg'], grad,
+                                         alpha, True)
+        state['step'] += 1
+
+        if vi > 0:
+            i_buffer = self.accumulate_integral(state, p.data)
+        else:
+            i_buffer = 0.
+
+        if vd > 0.:
+            d_buffer = state['d_buffer']
+            d_buffer = p.data - d_buffer
+            state['d_buffer'] = p.data
+        else:
+            d_buffer = 0.
+
+        controller = vp * p.data + vi * i_buffer + vd * d_buffer
+        controller = torch.clamp(controller, -10, 10)
+        # grad = grad.add(controller)
+
+        if group['centered']:
+            grad_avg = self.update_average(state['grad_avg'], grad,
+                                           alpha, False)
+            avg = square_avg.addcmul(
+                -1, grad_avg, grad_avg).sqrt().add_(group['eps'])
+        else:
+            avg = square_avg.sqrt().add_(group['eps'])
+
+        grad = grad.div(avg)
+        grad = grad.add(controller)
+        p.data.add_(-group['lr'], grad)
+
+    def sparse_step(self, p, state, group):
+        ''' Row-sparse step for the gradient of a sparse embedding.
+
+        Only the rows in the gradient are updated. Before that, rows that
+        were not in the gradients of the previous steps are caught up with
+        the updates they skipped, see catch_up_rows. The gradient of such a
+        row was computed at its stale value, unless the row was caught up
+        before the forward pass by register_catch_up. With that hook the
+        result matches the per-parameter step on the dense gradient up to
+        rounding.
+        '''
+        grad = p.grad.data.coalesce()
+        rows = grad._indices()[0]
+        grad = grad._values()
+
+        alpha = group['alpha']
+        vp = group['vp']
+        vi = group['vi']
+        vd = group['vd']
+
+        # State initialization, row_step is the last step of every row
+        if len(state) == 0:
+            self.init_state(state, p, group)
+        if 'row_step' not in state:
+            state['row_step'] = torch.full((p.size(0), ),
+                                           state['step'],
+                                           dtype=torch.long,
+                                           device=p.device)
+        self.catch_up_rows(p, state, group, rows, state['step'])
+        state['step'] += 1
+        state['row_step'][rows] = state['step']
+
+        param = p.data[rows]
+        row_state = gather_rows(state, rows)
+        square_avg = self.update_average(row_state['square_avg'], grad,
+                                         alpha, True)
+
+        if vi > 0:
+            i_buffer = self.accumulate_integral(row_state, param)
+        else:
+            i_buffer = 0.
+
+        if vd > 0.:
+            d_buffer = param - state['d_buffer'][rows]
+            state['d_buffer'] = p.data
+        else:
+            d_buffer = 0.
+
+        controller = vp * param + vi * i_buffer + vd * d_buffer
+        controller = torch.clamp(controller, -10, 10)
+
+        if group['centered']:
+            grad_avg = self.update_average(row_state['grad_avg'], grad,
+                                           alpha, False)
+            avg = square_avg.addcmul(grad_avg, grad_avg,
+                                     value=-1).sqrt_().add_(group['eps'])
+        else:
+            avg = square_avg.sqrt().add_(group['eps'])
+
+        grad = grad.div(avg)
+        grad = grad.add(controller)
+        p.data.index_add_(0, rows, grad, alpha=-group['lr'])
+        scatter_rows(state, row_state, rows)
+
+    def catch_up_rows(self, p, state, group, rows, step):
+        ''' Applies the updates that rows of a sparse parameter skipped
+        since their last step, as steps with a zero gradient.
+
+        The gradient averages decay by alpha per skipped step. The PID
+        controller still moves the rows with a zero gradient. Without the
+        clamp, k such steps are a linear map of the row and its integral,
+        applied at once with its k-th power. Rows whose controller is beyond
+        the clamp before or after the skipped steps are replayed step by
+        step instead, see replay_rows.
+
+        Args:
+            p (tensor): sparse parameter
+            state (dict): state of p
+            group (dict): parameter group of p
+            rows (tensor): rows to catch up
+            step (int): step the rows are brought to
+        '''
+        skipped = step - state['row_step'][rows]
+        behind = skipped > 0
+        rows = rows[behind]
+        skipped = skipped[behind]
+        if rows.numel() == 0:
+            return
+        state['row_step'][rows] = step
+
+        row_state = gather_rows(state, rows)
+        shape = (-1, ) + (1, ) * (p.dim() - 1)
+        decay = torch.full(skipped.shape,
+                           group['alpha'],
+                           dtype=p.dtype,
+                           device=p.device).pow_(skipped).view(shape)
+        for key in ['square_avg', 'grad_avg']:
+            if key in row_state:
+                row_state[key].copy_(row_state[key].to(p.dtype).mul_(decay))
+        scatter_rows(state, row_state, rows)
+
+        lr = group['lr']
+        vp = group['vp']
+        vi = group['vi']
+        if vp == 0 and vi == 0:
+            return
+
+        # A skipped step is i' = i + p, p' = p - lr * (vp * p + vi * i'),
+        # the derivative term is zero as in the dense step
+        param = p.data[rows]
+        if vi > 0:
+            integral = row_state['i_buffer'].to(p.dtype)
+            if 'i_buffer_comp' in row_state:
+                integral.add_(row_state['i_buffer_comp'].to(p.dtype))
+        else:
+            integral = torch.zeros_like(param)
+        m00, m01, m10, m11 = [
+            m.to(p.dtype).view(shape)
+            for m in linear_power(1 - lr * (vp + vi), lr * vi, skipped)
+        ]
+        new_param = m00 * param + m01 * integral
+        new_integral = m10 * param + m11 * integral
+
+        def unclamped(param, integral):
+            controller = vp * param + vi * (integral + param)
+            return controller.abs().view(len(rows), -1).max(1)[0] <= 10
+
+        exact = unclamped(param, integral) & unclamped(new_param, new_integral)
+        p.data.index_copy_(0, rows[exact], new_param[exact])
+        if vi > 0:
+            row_state = gather_rows(state, rows[exact])
+            self.accumulate_integral(row_state,
+                                     new_integral[exact] - integral[exact])
+            scatter_rows(state, row_state, rows[exact])
+        if not exact.all():
+            self.replay_rows(p, state, group, rows[~exact], skipped[~exact])
+
+    def replay_rows(self, p, state, group, rows, skipped):
+        ''' Replays the controller updates of skipped steps one step at a
+        time, for the rows that skipped at least that many steps.
+        '''
+        vp = group['vp']
+        vi = group['vi']
+        for i in range(skipped.max().item()):
+            # The derivative term is zero, as in the dense step
+            rows_i = rows[skipped > i]
+            param = p.data[rows_i]
+            controller = vp * param
+            if vi > 0:
+                row_state = gather_rows(state, rows_i)
+                i_buffer = self.accumulate_integral(row_state, param)
+                scatter_rows(state, row_state, rows_i)
+                controller = controller + vi * i_buffer
+            controller = torch.clamp(controller, -10, 10)
+            p.data.index_add_(0, rows_i, controller, alpha=-group['lr'])
+
+    def register_catch_up(self, embedding):
+        ''' Registers a forward pre-hook on an embedding that catches up the
+        rows it looks up, so that their gradients are computed at the rows
+        of the current step, as in the dense step.
+
+        Args:
+            embedding (nn.Embedding): embedding with sparse gradients whose
+                weight is optimized by this optimizer
+
+        Returns:
+            the handle of the hook
+        '''
+        p = embedding.weight
+        group = next(group for group in self.param_groups
+                     if any(q is p for q in group['params']))
+
+        def hook(module, inputs):
+            state = self.state[p]
+            if 'row_step' not in state:
+                return
+            rows = inputs[0].reshape(-1).unique()
+            with torch.no_grad():
+                self.catch_up_rows(p, state, group, rows, state['step'])
+
+        return embedding.register_forward_pre_hook(hook)
+
+    def catch_up(self):
+        ''' Brings all rows of sparse parameters to the current step, e.g.
+        before the parameters are evaluated or averaged.
+        '''
+        for group in self.param_groups:
+            for p in group['params']:
                 state = self.state[p]
+                if 'row_step' in state:
+                    rows = torch.arange(p.size(0), device=p.device)
+                    self.catch_up_rows(p, state, group, rows, state['step'])
+
+    def offload_step(self, group):
+        ''' Per-parameter step with the state in host memory.
+
+        The state of the next parameter is copied to the device on a side
+        stream while the current one is updated, and written back on the
+        same stream. On the CPU the state is copied into separate working
+        tensors and back, so the mode can be tested without a GPU.
+        '''
+        params = [p for p in group['params'] if p.grad is not None]
+        if len(params) == 0:
+            return
+        for p in params:
+            state = self.state[p]
+            if len(state) == 0:
+                self.init_state(state, p, group)
+                self.offload_state(state, self.param_index(p))
+
+        device = params[0].device
+        stream = None
+        if device.type == 'cuda':
+            if device not in self.copy_streams:
+                self.copy_streams[device] = torch.cuda.Stream(device)
+            stream = self.copy_streams[device]
+
+        def on_copy_stream():
+            if stream is None:
+                return contextlib.nullcontext()
+            return torch.cuda.stream(stream)
+
+        def fetch(p):
+            work = dict(self.state[p])
+            with on_copy_stream():
+                for key in offload_keys:
+                    if key in work:
+                        work[key] = work[key].to(device,
+                                                 non_blocking=True,
+                                                 copy=True)
+                if stream is not None:
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                    work['event'] = event
+            return work
+
+        next_work = fetch(params[0])
+        for i, p in enumerate(params):
+            work = next_work
+            if i + 1 < len(params):
+                next_work = fetch(params[i + 1])
+            if stream is not None:
+                torch.cuda.current_stream(device).wait_event(work.pop('event'))
+
+            self.param_step(p, work, group)
+
+            state = self.state[p]
+            if stream is not None:
+                stream.wait_stream(torch.cuda.current_stream(device))
+            with on_copy_stream():
+                for key in offload_keys:
+                    if key in state:
+                        state[key].copy_(work[key], non_blocking=True)
+            state['step'] = work['step']
+            for key in ['d_buffer', 'row_step']:
+                if key in work:
+                    state[key] = work[key]
+                elif key in state:
+                    del state[key]
+
+        # The host state is complete when step returns
+        if stream is not None:
+            stream.synchronize()
+
+    def offload_state(self, state, index):
+        ''' Moves the state tensors of a parameter to host memory.
+
+        With mmap there is one file per parameter index and state key in a
+        directory of this optimizer under offload_dir. Offloading again, e.g.
+        in load_state_dict, replaces the files, and they are removed with
+        the optimizer.
+        '''
+        for key in offload_keys:
+            if key not in state:
+                continue
+            value = state[key]
+            if self.offload == 'mmap' and value.numel() > 0:
+                if self.offload_subdir is None:
+                    self.offload_subdir = tempfile.mkdtemp(
+                        prefix='pid_rmsprop_', dir=self.offload_dir)
+                filename = os.path.join(self.offload_subdir,
+                                        'state_%06d_%s.bin' % (index, key))
+                # A previous mapping of the file stays readable until it is
+                # released
+                if os.path.exists(filename):
+                    os.remove(filename)
+                host = torch.from_file(filename,
+                                       shared=True,
+                                       size=value.numel(),
+                                       dtype=value.dtype).view(value.shape)
+            else:
+                host = torch.empty(value.shape,
+                                   dtype=value.dtype,
+                                   pin_memory=value.is_cuda)
+            host.copy_(value)
+            state[key] = host
+
+    def param_index(self, p):
+        ''' Returns the index of p over all parameter groups. '''
+        index = 0
+        for group in self.param_groups:
+            for q in group['params']:
+                if q is p:
+                    return index
+                index += 1
+        raise ValueError('Parameter is not optimized by this optimizer.')
+
+    def init_state(self, state, p, group):
+        dtype = self.state_dtype or p.dtype
+        state['step'] = 0
+        state['square_avg'] = torch.zeros_like(p.data, dtype=dtype)
+        if group['centered']:
+            state['grad_avg'] = torch.zeros_like(p.data, dtype=dtype)
+        if group['vi'] > 0:
+            state['i_buffer'] = torch.zeros_like(p.data, dtype=dtype)
+            if dtype != p.dtype and self.integral_rounding == 'kahan':
+                state['i_buffer_comp'] = torch.zeros_like(p.data,
+                                                          dtype=dtype)
+        if group['vd'] > 0:
+            state['d_buffer'] = p.data
+
+    def update_average(self, average, grad, alpha, square):
+        ''' Updates a moving average of the (squared) gradient and returns
+        it in the precision of the gradient.
+        '''
+        stored = average
+        if average.dtype != grad.dtype:
+            average = average.to(grad.dtype)
+        average.mul_(alpha)
+        if square:
+            average.addcmul_(grad, grad, value=1 - alpha)
+        else:
+            average.add_(grad, alpha=1 - alpha)
+        if average is not stored:
+            stored.copy_(average)
+        return average
+
+    def accumulate_integral(self, state, param):
+        ''' Adds the parameters to the integral buffer and returns the sum in
+        the precision of the parameters.
+
+        A reduced-precision buffer loses most of the small per-step
+        increments with round-to-nearest. With Kahan summation the rounding
+        error is kept in i_buffer_comp and added back at the next step,
+        stochastic rounding keeps the buffer unbiased instead.
+        '''
+        i_buffer = state['i_buffer']
+        if i_buffer.dtype == param.dtype:
+            return i_buffer.add_(param)
+
+        previous = i_buffer.to(param.dtype)
+        if 'i_buffer_comp' in state:
+            comp = state['i_buffer_comp']
+            update = comp.to(param.dtype).add_(param)
+            integral = previous + update
+            i_buffer.copy_(integral)
+            comp.copy_(update.sub_(i_buffer.to(param.dtype) - previous))
+        elif self.integral_rounding == 'stochastic':
+            integral = previous.add_(param)
+            stochastic_round_(i_buffer, integral,
+                              self.get_generator(param.device))
+        else:
+            integral = previous.add_(param)
+            i_buffer.copy_(integral)
+        return integral
+
+    def get_generator(self, device):
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(0)
+            self.generators[device] = generator
+        return self.generators[device]
 
-                alpha = group['alpha']
-                vp = group['vp']
-                vi = group['vi']
-                vd = group['vd']
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['square_avg'] = torch.zeros_like(p.data)
-                    if group['centered']:
-                        state['grad_avg'] = torch.zeros_like(p.data)
-                    if vi > 0:
-                        state['i_buffer'] = torch.zeros_like(p.data)
-                    if vd > 0:
-                        state['d_buffer'] = p.data
-
-                square_avg = state['square_avg']
-                square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
-                state['step'] += 1
-
-                if vi > 0:
-                    i_buffer = state['i_buffer']
-                    i_buffer.add_(p.data)
-                else:
-                    i_buffer = 0.
-
-                if vd > 0.:
-                    d_buffer = state['d_buffer']
-                    d_buffer = p.data - d_buffer
-                    state['d_buffer'] = p.data
-                else:
-                    d_buffer = 0.
-
-                controller = vp * p.data + vi * i_buffer + vd * d_buffer
-                controller = torch.clamp(controller, -10, 10)
-                # grad = grad.add(controller)
-
-                if group['centered']:
-                    grad_avg = state['grad_avg']
-                    grad_avg.mul_(alpha).add_(1 - alpha, grad)
-                    avg = square_avg.addcmul(
-                        -1, grad_avg, grad_avg).sqrt().add_(group['eps'])
-                else:
-                    avg = square_avg.sqrt().add_(group['eps'])
-
-                grad = grad.div(avg)
-                grad = grad.add(controller)
-                p.data.add_(-group['lr'], grad)
+    def foreach_step(self, group):
+        ''' Same update as the per-parameter loop of step, with one
+        multi-tensor op per stage for all parameters of the group.
+
+        Products with the coefficients are computed before they are added,
+        as in the loop, so that the results are bitwise identical.
+        '''
+        alpha = group['alpha']
+        vp = group['vp']
+        vi = group['vi']
+        vd = group['vd']
+
+        params, grads, states = [], [], []
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            state = self.state[p]
+            if p.grad.is_sparse:
+                self.param_step(p, state, group)
+                continue
+
+            # State initialization
+            if len(state) == 0:
+                self.init_state(state, p, group)
+            state['step'] += 1
+
+            params.append(p.data)
+            grads.append(p.grad.data)
+            states.append(state)
+        if len(params) == 0:
+            return
+
+        square_avgs = [state['square_avg'] for state in states]
+        torch._foreach_mul_(square_avgs, alpha)
+        torch._foreach_addcmul_(square_avgs, grads, grads, value=1 - alpha)
+
+        controller = torch._foreach_mul(params, vp)
+        if vi > 0:
+            i_buffers = [state['i_buffer'] for state in states]
+            torch._foreach_add_(i_buffers, params)
+            torch._foreach_add_(controller, torch._foreach_mul(i_buffers, vi))
+        if vd > 0:
+            d_buffers = torch._foreach_sub(
+                params, [state['d_buffer'] for state in states])
+            for state, p in zip(states, params):
+                state['d_buffer'] = p
+            torch._foreach_add_(controller, torch._foreach_mul(d_buffers, vd))
+        torch._foreach_clamp_min_(controller, -10)
+        torch._foreach_clamp_max_(controller, 10)
+
+        if group['centered']:
+            grad_avgs = [state['grad_avg'] for state in states]
+            torch._foreach_mul_(grad_avgs, alpha)
+            torch._foreach_add_(grad_avgs, grads, alpha=1 - alpha)
+            avg = torch._foreach_addcmul(square_avgs,
+                                         grad_avgs,
+                                         grad_avgs,
+                                         value=-1)
+            torch._foreach_sqrt_(avg)
+        else:
+            avg = torch._foreach_sqrt(square_avgs)
+        torch._foreach_add_(avg, group['eps'])
+
+        update = torch._foreach_div(grads, avg)
+        torch._foreach_add_(update, controller)
+        torch._foreach_add_(params, update, alpha=-group['lr'])
+
+    def flatten_group(self, group):
+        ''' Moves parameters, gradients and state of a group into flat
+        buffers.
+
+        Every parameter, its gradient and its state tensors become views
+        (with the original strides) into one contiguous buffer each, so
+        state_dict still has one entry per parameter. Existing gradients and
+        state, e.g. from load_state_dict, are copied over.
+        '''
+        params = group['params']
+        p0 = params[0]
+        for p in params:
+            if p.dtype != p0.dtype or p.device != p0.device:
+                raise ValueError('Flat groups need parameters of one dtype '
+                                 'and device.')
+        numel = sum(p.numel() for p in params)
+        offsets = []
+        offset = 0
+        for p in params:
+            offsets.append(offset)
+            offset += p.numel()
+
+        def flatten(tensors, dtype=None):
+            flat = p0.new_zeros(numel, dtype=dtype)
+            views = []
+            for p, t, offset in zip(params, tensors, offsets):
+                view = flat.as_strided(p.size(), p.stride(), offset)
+                if t is not None:
+                    view.copy_(t)
+                views.append(view)
+            return flat, views
+
+        flat_group = dict()
+        flat_group['param'], views = flatten([p.data for p in params])
+        for p, view in zip(params, views):
+            p.data = view
+        # Gradients zeroed in place stay views, so whether backward reached
+        # a parameter since zero_grad is recorded by a hook. Frozen
+        # parameters get no hook and count as having no gradient.
+        flat_group['has_grad'] = [
+            p.grad is not None and p.requires_grad for p in params
+        ]
+        flat_group['grad'], views = flatten([p.grad for p in params])
+        for p, view in zip(params, views):
+            p.grad = view
+        flat_group['hooks'] = [
+            p.register_post_accumulate_grad_hook(
+                mark_grad(flat_group['has_grad'], i))
+            for i, p in enumerate(params) if p.requires_grad
+        ]
+
+        # State initialization, as in the per-parameter loop
+        states = [self.state[p] for p in params]
+        for p, state in zip(params, states):
+            if len(state) == 0:
+                self.init_state(state, p, group)
+        for key in [
+                'square_avg', 'grad_avg', 'i_buffer', 'i_buffer_comp',
+                'd_buffer'
+        ]:
+            if key not in states[0]:
+                continue
+            flat_group[key], views = flatten([state[key] for state in states],
+                                             states[0][key].dtype)
+            for state, view in zip(states, views):
+                state[key] = view
+        return flat_group
+
+    def flat_step(self, index, group):
+        ''' Same update as the per-parameter loop of step, as a handful of
+        ops on the flat buffers of the group. As in the loop, parameters
+        without a gradient are not updated: their slices of the parameter
+        and state buffers are restored after the step.
+        '''
+        for p in group['params']:
+            if p.grad is not None and p.grad.is_sparse:
+                raise RuntimeError(
+                    'Flat groups do not support sparse gradients')
+        flat_group = self.flat_groups.get(index)
+        if flat_group is None:
+            flat_group = self.flatten_group(group)
+            self.flat_groups[index] = flat_group
+
+        alpha = group['alpha']
+        vp = group['vp']
+        vi = group['vi']
+        vd = group['vd']
+        params = group['params']
+
+        # Gradients that were replaced, e.g. set to None by the model's
+        # zero_grad, are copied back into the flat buffer
+        grad = flat_group['grad']
+        missing = []
+        offset = 0
+        for i, p in enumerate(params):
+            view = grad.as_strided(p.size(), p.stride(), offset)
+            offset += p.numel()
+            if p.grad is None or (p.grad.data_ptr() == view.data_ptr()
+                                  and not flat_group['has_grad'][i]):
+                missing.append((offset - p.numel(), offset))
+                view.zero_()
+            elif p.grad.data_ptr() != view.data_ptr():
+                self.state[p]['step'] += 1
+                view.copy_(p.grad)
+            else:
+                self.state[p]['step'] += 1
+                continue
+            p.grad = view
+        if len(missing) == len(params):
+            return
+        saved = [(flat_group[key], start, flat_group[key][start:end].clone())
+                 for start, end in missing for key in [
+                     'param', 'square_avg', 'grad_avg', 'i_buffer',
+                     'i_buffer_comp'
+                 ] if key in flat_group]
+
+        param = flat_group['param']
+        square_avg = self.update_average(flat_group['square_avg'], grad,
+                                         alpha, True)
+
+        controller = vp * param
+        if vi > 0:
+            i_buffer = self.accumulate_integral(flat_group, param)
+            controller.add_(vi * i_buffer)
+        if vd > 0:
+            d_buffer = param - flat_group['d_buffer']
+            flat_group['d_buffer'] = param
+            for p in params:
+                self.state[p]['d_buffer'] = p.data
+            controller.add_(vd * d_buffer)
+        controller.clamp_(-10, 10)
+
+        if group['centered']:
+            grad_avg = self.update_average(flat_group['grad_avg'], grad,
+                                           alpha, False)
+            avg = square_avg.addcmul(grad_avg, grad_avg,
+                                     value=-1).sqrt_().add_(group['eps'])
+        else:
+            avg = square_avg.sqrt().add_(group['eps'])
+
+        param.add_(grad.div(avg).add_(controller), alpha=-group['lr'])
+
+        for buffer, start, value in saved:
+            buffer[start:start + len(value)].copy_(value)
+
+
+
+class ShardedPID_RMSprop(Optimizer):
+    ''' PID_RMSprop with its state sharded across data-parallel ranks.
+
+    Every rank owns the state and the update of a partition of the
+    parameters, balanced by size. After the local step the updated
+    parameters are all-gathered. The gradients must already be averaged
+    across ranks, e.g. by DistributedDataParallel.
+
+    state_dict is collective and returns the full state in the format of
+    PID_RMSprop, load_state_dict keeps the entries of the owned parameters,
+    so checkpoints are independent of the number of ranks.
+
+    Args:
+        params (iterable): parameters or parameter groups
+        lr, alpha, eps, vp, vi, vd, centered: as in PID_RMSprop
+        process_group (ProcessGroup): group to shard over, default group
+            if None
+        **kwargs: state options of PID_RMSprop, e.g. state_precision
+    '''
+    def __init__(self,
+                 params,
+                 lr=1e-2,
+                 alpha=0.99,
+                 eps=1e-8,
+                 vp=0.,
+                 vi=0.,
+                 vd=0.,
+                 centered=False,
+                 process_group=None,
+                 **kwargs):
+        self.process_group = process_group
+        self.rank = dist.get_rank(process_group)
+        self.world_size = dist.get_world_size(process_group)
+
+        # Group hyperparameters live here and are copied to the local groups
+        defaults = dict(lr=lr,
+                        alpha=alpha,
+                        eps=eps,
+                        centered=centered,
+                        vp=vp,
+                        vi=vi,
+                        vd=vd)
+        super(ShardedPID_RMSprop, self).__init__(params, defaults)
+
+        self.params = [
+            p for group in self.param_groups for p in group['params']
+        ]
+        for p in self.params:
+            if p.dtype != self.params[0].dtype:
+                raise ValueError('Sharding needs parameters of one dtype.')
+        self.owners = partition(self.params, self.world_size)
+        self.shard_numel = max(
+            sum(p.numel() for p, owner in zip(self.params, self.owners)
+                if owner == rank) for rank in range(self.world_size))
+
+        # Owned parameters, per group in the original order
+        self.local_indices = []
+        self.local_groups = []
+        local_groups = []
+        index = 0
+        for group in self.param_groups:
+            local_params = []
+            for p in group['params']:
+                if self.owners[index] == self.rank:
+                    self.local_indices.append(index)
+                    local_params.append(p)
+                index += 1
+            if len(local_params) > 0:
+                local_group = dict(group)
+                local_group['params'] = local_params
+                local_groups.append(local_group)
+                self.local_groups.append(group)
+
+        self.optimizer = None
+        if len(local_groups) > 0:
+            self.optimizer = PID_RMSprop(local_groups, **kwargs)
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        if self.optimizer is not None:
+            # Hyperparameters may have been changed, e.g. by a scheduler
+            for group, local_group in zip(self.local_groups,
+                                          self.optimizer.param_groups):
+                for key, value in group.items():
+                    if key != 'params':
+                        local_group[key] = value
+            self.optimizer.step()
+        self.all_gather_params()
 
         return loss
+
+    def catch_up(self):
+        ''' Catches up the owned sparse parameters, see
+        PID_RMSprop.catch_up, and gathers the parameters again.
+        '''
+        if self.optimizer is not None:
+            self.optimizer.catch_up()
+        self.all_gather_params()
+
+    @torch.no_grad()
+    def all_gather_params(self):
+        ''' Copies the parameters of every rank to all other ranks. '''
+        p0 = self.params[0]
+        shards = [
+            p0.new_zeros(self.shard_numel) for _ in range(self.world_size)
+        ]
+        offset = 0
+        for p, owner in zip(self.params, self.owners):
+            if owner == self.rank:
+                shards[self.rank][offset:offset + p.numel()].copy_(
+                    p.data.flatten())
+                offset += p.numel()
+        dist.all_gather(shards, shards[self.rank], group=self.process_group)
+
+        offsets = [0] * self.world_size
+        for p, owner in zip(self.params, self.owners):
+            if owner != self.rank:
+                offset = offsets[owner]
+                p.data.copy_(shards[owner][offset:offset +
+                                           p.numel()].view_as(p))
+            offsets[owner] += p.numel()
+
+    def state_dict(self):
+        ''' Returns the full state, gathered from all ranks. '''
+        local_state = dict()
+        if self.optimizer is not None:
+            local_state_dict = self.optimizer.state_dict()
+            for local_index, state in local_state_dict['state'].items():
+                local_state[self.local_indices[local_index]] = dict(
+                    (k, v.cpu() if torch.is_tensor(v) else v)
+                    for k, v in state.items())
+        states = [None] * self.world_size
+        dist.all_gather_object(states,
+                               local_state,
+                               group=self.process_group)
+
+        full_state = dict()
+        for state in states:
+            full_state.update(state)
+        param_groups = []
+        index = 0
+        for group in self.param_groups:
+            packed = dict((k, v) for k, v in group.items() if k != 'params')
+            packed['params'] = list(range(index,
+                                          index + len(group['params'])))
+            index += len(group['params'])
+            param_groups.append(packed)
+        return dict(state=full_state, param_groups=param_groups)
+
+    def load_state_dict(self, state_dict):
+        ''' Loads the owned part of a full PID_RMSprop state. '''
+        for group, saved_group in zip(self.param_groups,
+                                      state_dict['param_groups']):
+            for key, value in saved_group.items():
+                if key != 'params':
+                    group[key] = value
+        if self.optimizer is None:
+            return
+
+        local_state = dict()
+        for local_index, index in enumerate(self.local_indices):
+            if index in state_dict['state']:
+                local_state[local_index] = state_dict['state'][index]
+        local_state_dict = self.optimizer.state_dict()
+        local_state_dict['state'] = local_state
+        for group, local_group in zip(self.local_groups,
+                                      local_state_dict['param_groups']):
+            for key, value in group.items():
+                if key != 'params':
+                    local_group[key] = value
+        self.optimizer.load_state_dict(local_state_dict)
+
+
+def mark_grad(has_grad, index):
+    ''' Returns a post-accumulate-grad hook that sets has_grad[index]. '''
+    def hook(p):
+        has_grad[index] = True
+
+    return hook
+
+
+def linear_power(a, b, k):
+    ''' Returns the entries m00, m01, m10, m11 of [[a, -b], [1, 1]] ** k for
+    a tensor of exponents k, as float64 tensors, by repeated squaring.
+    '''
+    ones = torch.ones(k.shape, dtype=torch.float64, device=k.device)
+    zeros = torch.zeros_like(ones)
+    m = [ones, zeros, zeros, ones]
+    base = [a, -b, 1., 1.]
+    k = k.clone()
+    while True:
+        odd = (k & 1).bool()
+        product = [
+            m[0] * base[0] + m[1] * base[2],
+            m[0] * base[1] + m[1] * base[3],
+            m[2] * base[0] + m[3] * base[2],
+            m[2] * base[1] + m[3] * base[3],
+        ]
+        m = [torch.where(odd, x, y) for x, y in zip(product, m)]
+        k >>= 1
+        if not (k > 0).any():
+            return m
+        base = [
+            base[0] * base[0] + base[1] * base[2],
+            base[0] * base[1] + base[1] * base[3],
+            base[2] * base[0] + base[3] * base[2],
+            base[2] * base[1] + base[3] * base[3],
+        ]
+
+
+def gather_rows(state, rows):
+    ''' Returns copies of the given rows of the state tensors, on the device
+    of rows (state may be offloaded).
+    '''
+    return dict((key, state[key][rows.to(state[key].device)].to(rows.device))
+                for key in offload_keys if key in state)
+
+
+def scatter_rows(state, row_state, rows):
+    ''' Writes rows returned by gather_rows back into the state. '''
+    for key, value in row_state.items():
+        device = state[key].device
+        state[key].index_copy_(0, rows.to(device), value.to(device))
+
+
+def partition(params, world_size):
+    ''' Assigns every parameter to a rank, largest first to the rank with
+    the fewest elements so far.
+    '''
+    owners = [0] * len(params)
+    sizes = [0] * world_size
+    order = sorted(range(len(params)), key=lambda i: -params[i].numel())
+    for i in order:
+        rank = sizes.index(min(sizes))
+        owners[i] = rank
+        sizes[rank] += params[i].numel()
+    return owners
+
+
+def stochastic_round_(out, x, generator=None):
+    ''' Rounds the fp32 tensor x into the bf16 tensor out, up or down with
+    probabilities proportional to the distance, so that the rounding is
+    unbiased.
+    '''
+    noise = torch.randint(0,
+                          1 << 16,
+                          x.shape,
+                          dtype=torch.int32,
+                          device=x.device,
+                          generator=generator)
+    # The low 16 bits are cut off, so the conversion to bf16 is exact
+    bits = (x.view(torch.int32) + noise).bitwise_and_(-65536)
+    out.copy_(bits.view(torch.float32))
@@ -0,0 +1,71 @@
+import resource
+import time
+import torch
+
+
+def synchronize(device=None):
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_steps(fn, nsteps, nwarmup=1, device=None):
+    ''' Returns the mean wall clock time of fn() in seconds.
+
+    Args:
+        fn (callable): function to time
+        nsteps (int): number of timed calls
+        nwarmup (int): number of untimed calls before timing
+        device (device): device whose queued work is waited for
+    '''
+    for _ in range(nwarmup):
+        fn()
+    synchronize(device)
+    t0 = time.perf_counter()
+    for _ in range(nsteps):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - t0) / nsteps
+
+
+def reset_peak_memory(device=None):
+    ''' Resets the peak memory counter of the device.
+
+    On the CPU this resets the peak resident set size of the process where
+    the kernel allows it (Linux /proc/self/clear_refs).
+    '''
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_memory(device=None):
+    ''' Returns the peak allocated (cuda) or resident (cpu) memory in bytes.
+    '''
+    if device is not None and torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+def total_memory(device=None):
+    ''' Returns the total memory of the device (cuda) or host (cpu) in bytes.
+    '''
+    if device is not None and torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise OSError('Could not read /proc/meminfo.')
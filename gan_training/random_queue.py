@@ -51,3 +51,11 @@ class Random_queue(object):
             img = np.stack(results, 0).astype(np.float32)
             lab = np.array(results_l).astype(np.int64)
             return img, lab
+
+    def state_dict(self):
+        return dict(length=self.length, data=self.data, label=self.label)
+
+    def load_state_dict(self, state_dict):
+        self.length = state_dict['length']
+        self.data = state_dict['data']
+        self.label = state_dict['label']
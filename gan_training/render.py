@@ -0,0 +1,67 @@
+import queue
+import multiprocessing
+from gan_training.eval import toy_render_dict
+from gan_training.logger import Logger
+
+
+class ToyRenderer(object):
+    ''' Renders toy samples in a background process.
+
+    Frames are handed over through a bounded queue. When the renderer falls
+    behind, new frames are dropped instead of blocking training. The process
+    is spawned rather than forked, so it does not inherit the CUDA context or
+    the threads of the training process. close() renders the pending frames.
+
+    Args:
+        x_real (array): real samples of shape [N, 2], sent once
+        logger_kwargs (dict): arguments for the Logger of the render process
+        queue_size (int): maximum number of pending frames
+        toy_renderer (str): name of the render function in toy_render_dict
+    '''
+    def __init__(self,
+                 x_real,
+                 logger_kwargs,
+                 queue_size=2,
+                 toy_renderer='matplotlib'):
+        ctx = multiprocessing.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=queue_size)
+        self.process = ctx.Process(target=render_worker,
+                                   args=(self.queue, x_real, logger_kwargs,
+                                         toy_renderer),
+                                   daemon=True)
+        self.process.start()
+        self.ndropped = 0
+
+    def submit(self, it, x_fake, contour_matrix):
+        ''' Queues a frame, returns False if it was dropped.
+
+        Args:
+            it (int): iteration of the frame
+            x_fake (array): generated samples of shape [M, 2]
+            contour_matrix (array): discriminator output on a square grid
+        '''
+        try:
+            self.queue.put_nowait((it, x_fake, contour_matrix))
+        except queue.Full:
+            self.ndropped += 1
+            return False
+        return True
+
+    def close(self):
+        ''' Waits until the pending frames are rendered. '''
+        if self.process.is_alive():
+            self.queue.put(None)
+        self.process.join()
+
+
+def render_worker(frame_queue, x_real, logger_kwargs, toy_renderer):
+    render_toy = toy_render_dict[toy_renderer]
+    logger = Logger(**logger_kwargs)
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            break
+        it, x_fake, contour_matrix = frame
+        x = render_toy(x_real, x_fake, contour_matrix)
+        logger.add_imgs(x[0:1], 'all', it)
+        logger.add_imgs(x[1:2], 'all', it + 1)
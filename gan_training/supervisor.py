@@ -0,0 +1,115 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Exit code of a trainer that saved its checkpoint and wants to be relaunched
+RESTART_EXIT_CODE = 3
+
+
+class StopSignal(object):
+    ''' Records SIGTERM and SIGUSR1 instead of dying on them.
+
+    The training loop checks received once per iteration, saves a checkpoint
+    and exits with RESTART_EXIT_CODE, so a preempted run only loses the
+    current iteration.
+
+    Args:
+        signums (list): signals to catch
+    '''
+    def __init__(self, signums=(signal.SIGTERM, signal.SIGUSR1)):
+        self.signum = None
+        for signum in signums:
+            signal.signal(signum, self.handle)
+
+    def handle(self, signum, frame):
+        self.signum = signum
+
+    @property
+    def received(self):
+        return self.signum is not None
+
+    @property
+    def name(self):
+        return signal.Signals(self.signum).name
+
+
+class Supervisor(object):
+    ''' Relaunches a trainer until it finishes.
+
+    Exit code 0 ends supervision. RESTART_EXIT_CODE (restart_every elapsed or
+    emergency save) relaunches right away. Any other exit code counts as a
+    crash and relaunches after restart_delay seconds, until max_crashes
+    consecutive crashes happened. SIGTERM and SIGUSR1 are forwarded to the
+    trainer, which saves and exits, and then supervision ends. Every run is
+    appended to log_file.
+
+    Args:
+        cmd (list): trainer command line
+        checkpoint_io (CheckpointIO): checkpoints of the run
+        log_file (str): json file with one entry per run
+        max_crashes (int): number of consecutive crashes to give up after
+        restart_delay (float): seconds to wait before relaunching a crash
+    '''
+    def __init__(self,
+                 cmd,
+                 checkpoint_io,
+                 log_file,
+                 max_crashes=5,
+                 restart_delay=10.):
+        self.cmd = cmd
+        self.checkpoint_io = checkpoint_io
+        self.log_file = log_file
+        self.max_crashes = max_crashes
+        self.restart_delay = restart_delay
+        self.process = None
+        self.stop_signum = None
+
+        self.runs = []
+        if os.path.exists(log_file):
+            with open(log_file, 'r') as f:
+                self.runs = json.load(f)
+
+        for signum in (signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(signum, self.forward)
+
+    def forward(self, signum, frame):
+        self.stop_signum = signum
+        if self.process is not None:
+            self.process.send_signal(signum)
+
+    def run(self):
+        ncrashes = 0
+        while True:
+            checkpoint = self.checkpoint_io.latest_checkpoint()
+            print('Supervisor: launching run %d from %s' %
+                  (len(self.runs), checkpoint or 'initialization'))
+            tstart = time.time()
+            self.process = subprocess.Popen(self.cmd)
+            returncode = self.process.wait()
+            self.process = None
+
+            ncrashes = (0 if returncode in (0, RESTART_EXIT_CODE) else
+                        ncrashes + 1)
+            self.runs.append(
+                dict(start=tstart,
+                     end=time.time(),
+                     returncode=returncode,
+                     checkpoint=checkpoint,
+                     restarts=len(self.runs),
+                     crashes=ncrashes))
+            with open(self.log_file, 'w') as f:
+                json.dump(self.runs, f, indent=2)
+
+            if returncode == 0 or self.stop_signum is not None:
+                return returncode
+            if ncrashes >= self.max_crashes:
+                print('Supervisor: giving up after %d crashes' % ncrashes,
+                      file=sys.stderr)
+                return returncode
+            if returncode != RESTART_EXIT_CODE:
+                time.sleep(self.restart_delay)
+                if self.stop_signum is not None:
+                    return returncode
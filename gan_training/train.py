@@ -4,6 +4,7 @@ from torch.nn import functional as F
 import torch.utils.data
 import torch.utils.data.distributed
 from torch import autograd
+from gan_training import utils
 
 
 class Trainer(object):
@@ -35,7 +36,7 @@ class Trainer(object):
 
         return gloss.item()
 
-    def discriminator_trainstep(self, x_real, y, z):
+    def discriminator_trainstep(self, x_real, y, z, x_fake=None):
         toggle_grad(self.generator, False)
         toggle_grad(self.discriminator, True)
         self.generator.train()
@@ -56,8 +57,9 @@ class Trainer(object):
             dloss_real.backward()
 
         # On fake data
-        with torch.no_grad():
-            x_fake = self.generator(z, y)
+        if x_fake is None:
+            with torch.no_grad():
+                x_fake = self.generator(z, y)
 
         x_fake.requires_grad_()
         d_fake = self.discriminator(x_fake, y)
@@ -155,9 +157,4 @@ def update_average(model_tgt, model_src, beta):
     toggle_grad(model_src, False)
     toggle_grad(model_tgt, False)
 
-    param_dict_src = dict(model_src.named_parameters())
-
-    for p_name, p_tgt in model_tgt.named_parameters():
-        p_src = param_dict_src[p_name]
-        assert (p_src is not p_tgt)
-        p_tgt.copy_(beta * p_tgt + (1. - beta) * p_src)
+    utils.update_average(model_tgt, model_src, beta)
@@ -0,0 +1,240 @@
+# coding: utf-8
+import copy
+import queue
+import time
+import torch
+import torch.multiprocessing as mp
+from gan_training.config import build_optimizers, get_memory_format
+from gan_training.distributions import get_ydist, get_zdist
+from gan_training.inputs import get_dataset, get_batch_augment
+from gan_training.train_pid import Trainer
+from gan_training.train import Trainer as Trainer_reg
+
+reg_types = ['real', 'fake', 'real_fake', 'wgangp', 'wgangp0']
+
+
+class SharedModel(object):
+    ''' Model whose weights live in shared memory.
+
+    The owning worker publishes its private weights into it every few steps,
+    the other worker pulls them into a local replica. The version is the
+    step of the owning worker at the last publish.
+
+    Args:
+        model (nn.Module): model to share
+    '''
+    def __init__(self, model):
+        self.model = copy.deepcopy(model).share_memory()
+        self.lock = mp.Lock()
+        self.version = mp.Value('l', 0)
+
+    def publish(self, model, step):
+        with self.lock, torch.no_grad():
+            copy_state(self.model, model)
+            self.version.value = step
+
+    def pull(self, model):
+        with self.lock, torch.no_grad():
+            copy_state(model, self.model)
+            return self.version.value
+
+
+class AsyncStats(object):
+    ''' Throughput and staleness of one worker since the last report. '''
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.t0 = time.time()
+        self.nsteps = 0
+        self.staleness = 0.
+        self.loss = 0.
+
+    def add(self, loss, staleness):
+        self.nsteps += 1
+        self.loss += loss
+        self.staleness += staleness
+
+    def report(self, step):
+        nsteps = max(self.nsteps, 1)
+        out = dict(worker=self.name,
+                   step=step,
+                   steps_per_sec=self.nsteps / (time.time() - self.t0),
+                   staleness=self.staleness / nsteps,
+                   loss=self.loss / nsteps)
+        self.reset()
+        return out
+
+
+def copy_state(model_tgt, model_src):
+    for p_tgt, p_src in zip(model_tgt.parameters(), model_src.parameters()):
+        p_tgt.copy_(p_src)
+    for b_tgt, b_src in zip(model_tgt.buffers(), model_src.buffers()):
+        b_tgt.copy_(b_src)
+
+
+def get_fake(fake_queue, stop):
+    ''' Returns the next fake batch and its G version, or None once stop is
+    set, e.g. because the G worker failed.
+    '''
+    while not stop.is_set():
+        try:
+            return fake_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def build_trainer(generator, discriminator, g_optimizer, d_optimizer, config):
+    if config['training']['reg_type'] in reg_types:
+        return Trainer_reg(generator,
+                           discriminator,
+                           g_optimizer,
+                           d_optimizer,
+                           gan_type=config['training']['gan_type'],
+                           reg_type=config['training']['reg_type'],
+                           reg_param=config['training']['reg_param'])
+    else:
+        return Trainer(generator,
+                       discriminator,
+                       g_optimizer,
+                       d_optimizer,
+                       gan_type=config['training']['gan_type'],
+                       reg_type=config['training']['reg_type'],
+                       reg_param=config['training']['reg_param'],
+                       pv=config['training']['pv'],
+                       iv=config['training']['iv'],
+                       dv=config['training']['dv'],
+                       batch_size=config['training']['batch_size'],
+                       config=config)
+
+
+def generator_worker(config, shared_g, shared_d, fake_queue, stats_queue,
+                     g_step, d_step, stop):
+    ''' Trains G against a bounded-stale replica of D and streams fakes. '''
+    try:
+        torch.set_num_threads(config['async']['g_threads'])
+        torch.manual_seed(config['async']['seed'])
+        batch_size = config['training']['batch_size']
+        sync_every = config['async']['sync_every']
+        log_every = config['async']['log_every']
+
+        generator = copy.deepcopy(shared_g.model)
+        discriminator = copy.deepcopy(shared_d.model)
+        g_optimizer, _ = build_optimizers(generator, discriminator, config)
+        trainer = build_trainer(generator, discriminator, g_optimizer, None,
+                                config)
+
+        ydist = get_ydist(1)
+        zdist = get_zdist(config['z_dist']['type'], config['z_dist']['dim'])
+        stats = AsyncStats('generator')
+
+        it = 0
+        d_version = shared_d.pull(discriminator)
+        while not stop.is_set():
+            # Fake batch for the discriminator, produced by the current G
+            z = zdist.sample((batch_size, ))
+            y = ydist.sample((batch_size, ))
+            # As in discriminator_trainstep, with batch statistics
+            with torch.no_grad():
+                generator.train()
+                x_fake = generator(z, y)
+            while not stop.is_set():
+                try:
+                    fake_queue.put((x_fake, it), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            z = zdist.sample((batch_size, ))
+            y = ydist.sample((batch_size, ))
+            gloss = trainer.generator_trainstep(y, z)
+            it += 1
+            g_step.value = it
+            stats.add(gloss, d_step.value - d_version)
+
+            if it % sync_every == 0:
+                shared_g.publish(generator, it)
+                d_version = shared_d.pull(discriminator)
+
+            if it % log_every == 0:
+                stats_queue.put(stats.report(it))
+
+        shared_g.publish(generator, it)
+    finally:
+        # A failing worker also stops the other one
+        stop.set()
+        # Fakes left in the queue are never consumed
+        fake_queue.cancel_join_thread()
+
+
+def discriminator_worker(config, shared_g, shared_d, fake_queue, stats_queue,
+                         g_step, d_step, stop):
+    ''' Trains D on real data and the fakes streamed by the G worker. '''
+    try:
+        torch.set_num_threads(config['async']['d_threads'])
+        torch.manual_seed(config['async']['seed'] + 1)
+        batch_size = config['training']['batch_size']
+        sync_every = config['async']['sync_every']
+        log_every = config['async']['log_every']
+        niter = config['async']['niter']
+        memory_format = get_memory_format(config)
+
+        train_dataset, _ = get_dataset(
+            name=config['data']['type'],
+            data_dir=config['data']['train_dir'],
+            size=config['data']['img_size'],
+            lsun_categories=config['data']['lsun_categories_train'],
+            config=config)
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            num_workers=config['training']['nworkers'],
+            shuffle=True,
+            drop_last=True)
+        batch_augment = get_batch_augment(config)
+
+        discriminator = copy.deepcopy(shared_d.model)
+        _, d_optimizer = build_optimizers(shared_g.model, discriminator,
+                                          config)
+        trainer = build_trainer(shared_g.model, discriminator, None,
+                                d_optimizer, config)
+        stats = AsyncStats('discriminator')
+
+        it = 0
+        while it < niter and not stop.is_set():
+            for x_real, y in train_loader:
+                if batch_augment is not None:
+                    x_real = batch_augment(x_real)
+                if x_real.dim() == 4:
+                    x_real = x_real.contiguous(memory_format=memory_format)
+                y.clamp_(None, 0)
+                fake = get_fake(fake_queue, stop)
+                if fake is None:
+                    break
+                x_fake, g_version = fake
+                z = None
+                if isinstance(trainer, Trainer_reg):
+                    dloss, _ = trainer.discriminator_trainstep(
+                        x_real, y, z, x_fake=x_fake)
+                else:
+                    dloss, _, _ = trainer.discriminator_trainstep(
+                        x_real, y, z, it, x_fake=x_fake)
+                it += 1
+                d_step.value = it
+                stats.add(dloss, g_step.value - g_version)
+
+                if it % sync_every == 0:
+                    shared_d.publish(discriminator, it)
+
+                if it % log_every == 0:
+                    stats_queue.put(stats.report(it))
+
+                if it >= niter:
+                    break
+
+        shared_d.publish(discriminator, it)
+    finally:
+        # A failing worker also stops the other one
+        stop.set()
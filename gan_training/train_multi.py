@@ -0,0 +1,317 @@
+# coding: utf-8
+import copy
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.func import stack_module_state, functional_call, vmap
+from gan_training.train_pid import toggle_grad
+
+
+class ReplicaStack(nn.Module):
+    ''' Stacks K independent copies of a model into one module.
+
+    Every parameter is stored once with a leading replica dimension and the
+    forward pass is vmapped over it, so the K replicas run as a single batched
+    computation. Inputs are expected with the same leading dimension.
+
+    Args:
+        models (list): list of modules with identical architecture
+    '''
+    def __init__(self, models):
+        super().__init__()
+        params, buffers = stack_module_state(models)
+        self.nreplicas = len(models)
+
+        self.param_names = list(params.keys())
+        self.stacked_params = nn.ParameterList(
+            [nn.Parameter(params[n].detach()) for n in self.param_names])
+
+        self.buffer_names = list(buffers.keys())
+        for i, n in enumerate(self.buffer_names):
+            self.register_buffer('stacked_buffer_%d' % i, buffers[n])
+
+        # Stateless template, kept out of the module tree so that it is
+        # neither checkpointed nor moved around by .to()
+        self.__dict__['base'] = copy.deepcopy(models[0]).to('meta')
+
+    def stacked_state(self):
+        params = dict(zip(self.param_names, self.stacked_params))
+        buffers = {
+            n: getattr(self, 'stacked_buffer_%d' % i)
+            for i, n in enumerate(self.buffer_names)
+        }
+        return params, buffers
+
+    def forward(self, x, y):
+        params, buffers = self.stacked_state()
+
+        def call(p, b, x, y):
+            return functional_call(self.base, (p, b), (x, y))
+
+        return vmap(call)(params, buffers, x, y)
+
+    def replica(self, k):
+        ''' Returns a standalone copy of replica k.
+
+        Args:
+            k (int): index of the replica
+        '''
+        params, buffers = self.stacked_state()
+        device = self.stacked_params[0].device
+        model = copy.deepcopy(self.base).to_empty(device=device)
+        state_dict = {n: p[k].detach() for n, p in params.items()}
+        state_dict.update({n: b[k] for n, b in buffers.items()})
+        model.load_state_dict(state_dict)
+        return model
+
+
+class ReplicaQueue(object):
+    ''' Per-replica counterpart of Random_queue.
+
+    Holds one buffer of past samples per replica on the training device so
+    that the integral term never leaves the device.
+
+    Args:
+        nreplicas (int): number of replicas
+        capacity (int): number of samples kept per replica
+        batch_size (int): default number of samples returned by get_data
+    '''
+    def __init__(self, nreplicas, capacity, batch_size):
+        self.nreplicas = nreplicas
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.length = 0
+        self.data = None
+        self.label = None
+
+    def set_data(self, samples, y):
+        nreplicas, n = samples.shape[:2]
+        if self.data is None:
+            self.data = samples.new_zeros((nreplicas, self.capacity) +
+                                          samples.shape[2:])
+            self.label = y.new_zeros((nreplicas, self.capacity))
+
+        if self.length < self.capacity:
+            n = min(n, self.capacity - self.length)
+            self.data[:, self.length:self.length + n] = samples[:, :n]
+            self.label[:, self.length:self.length + n] = y[:, :n]
+            self.length += n
+        else:
+            index = self._random_index(n)
+            rows = self._rows(samples.device)
+            self.data[rows, index] = samples
+            self.label[rows, index] = y
+
+    def get_data(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        if batch_size > self.length:
+            return self.data[:, :self.length], self.label[:, :self.length]
+
+        index = self._random_index(batch_size)
+        rows = self._rows(self.data.device)
+        return self.data[rows, index], self.label[rows, index]
+
+    def _random_index(self, n):
+        weights = torch.ones(self.nreplicas,
+                             self.length,
+                             device=self.data.device)
+        return torch.multinomial(weights, n, replacement=False)
+
+    def _rows(self, device):
+        return torch.arange(self.nreplicas, device=device).unsqueeze(1)
+
+
+class MultiTrainer(object):
+    ''' PID trainer for K stacked replicas trained in lockstep.
+
+    Mirrors gan_training.train_pid.Trainer, but every loss is computed per
+    replica and pv, iv and dv are per-replica coefficients. All returned
+    losses are arrays with one entry per replica.
+
+    Args:
+        generator (ReplicaStack): stacked generators
+        discriminator (ReplicaStack): stacked discriminators
+        g_optimizer (Optimizer): optimizer over the stacked generators
+        d_optimizer (Optimizer): optimizer over the stacked discriminators
+        gan_type (str): type of GAN loss
+        pv (Tensor): proportional coefficients, one per replica
+        iv (Tensor): integral coefficients, one per replica
+        dv (Tensor): derivative coefficients, one per replica
+        batch_size (int): batch size per replica
+        config (dict): config dictionary
+    '''
+    def __init__(self,
+                 generator,
+                 discriminator,
+                 g_optimizer,
+                 d_optimizer,
+                 gan_type,
+                 pv,
+                 iv,
+                 dv,
+                 batch_size=64,
+                 config=None):
+        print("Using multi-replica PID Trainer")
+        self.generator = generator
+        self.discriminator = discriminator
+        self.g_optimizer = g_optimizer
+        self.d_optimizer = d_optimizer
+
+        self.gan_type = gan_type
+        self.nreplicas = generator.nreplicas
+
+        self.pv = pv
+        self.iv = iv
+        self.dv = dv
+        self.batch_size = batch_size
+        self.config = config
+
+        self.d_xreal = None
+        self.d_xfake = None
+        self.d_previous_y = None
+
+        self.i_real_queue = ReplicaQueue(
+            self.nreplicas, config['training']['batch_size'] *
+            config['training']['i_buffer_factor'],
+            config['training']['batch_size'])
+        self.i_fake_queue = ReplicaQueue(
+            self.nreplicas, config['training']['batch_size'] *
+            config['training']['i_buffer_factor'],
+            config['training']['batch_size'])
+
+    def generator_trainstep(self, y, z):
+        assert (y.shape[:2] == z.shape[:2])
+        toggle_grad(self.generator, True)
+        toggle_grad(self.discriminator, False)
+        self.generator.train()
+        self.discriminator.train()
+        self.g_optimizer.zero_grad()
+
+        x_fake = self.generator(z, y)
+        d_fake = self.discriminator(x_fake, y)
+        gloss = self.compute_loss(d_fake, 1, is_generator=True)
+        gloss.sum().backward()
+
+        self.g_optimizer.step()
+
+        return gloss.detach().cpu().numpy()
+
+    def discriminator_trainstep(self, x_real, y, z, it=0):
+        toggle_grad(self.generator, False)
+        toggle_grad(self.discriminator, True)
+        self.generator.train()
+        self.discriminator.train()
+        self.d_optimizer.zero_grad()
+
+        reg_d = self.config['training']['regularize_output_d']
+        d_real = self.discriminator(x_real, y)
+        dloss_real = self.compute_loss(d_real, 1) * self.pv
+        if reg_d > 0.:
+            dloss_real += self.replica_mean(d_real**2) * reg_d
+
+        # On fake data
+        with torch.no_grad():
+            x_fake = self.generator(z, y)
+
+        d_fake = self.discriminator(x_fake, y)
+        dloss_fake = self.compute_loss(d_fake, 0) * self.pv
+        if reg_d > 0.:
+            dloss_fake += self.replica_mean(d_fake**2) * reg_d
+
+        dloss = dloss_real + dloss_fake
+        total_loss = dloss
+
+        i_loss = dloss.new_zeros(self.nreplicas)
+        if (self.iv > 0).any():
+            self.i_real_queue.set_data(x_real.detach(), y)
+            self.i_fake_queue.set_data(x_fake.detach(), y)
+
+            i_xreal, i_yreal = self.i_real_queue.get_data()
+            i_xfake, i_yfake = self.i_fake_queue.get_data()
+
+            i_real_doutput = self.discriminator(i_xreal, i_yreal)
+            i_fake_doutput = self.discriminator(i_xfake, i_yfake)
+
+            pid_type = self.config['training']['pid_type']
+            if pid_type == 'function':
+                i_loss = (self.compute_loss(i_real_doutput, 1) +
+                          self.compute_loss(i_fake_doutput, 0)) * self.iv
+            elif pid_type == 'square':
+                i_loss = (self.replica_mean(i_real_doutput**2) +
+                          self.replica_mean(i_fake_doutput**2)) * self.iv
+            elif pid_type == 'abs':
+                i_loss = (self.replica_mean(torch.abs(i_real_doutput)) +
+                          self.replica_mean(torch.abs(i_fake_doutput))
+                          ) * self.iv
+            elif pid_type == 'accurate':
+                i_fake_doutput = F.relu(i_fake_doutput)
+                i_real_doutput = -1 * F.relu(-1 * i_real_doutput)
+                i_loss = self.replica_mean(i_fake_doutput -
+                                           i_real_doutput) * self.iv
+            total_loss = total_loss + i_loss
+
+        d_loss = dloss.new_zeros(self.nreplicas)
+        if (self.dv > 0).any() and it > 0:
+            if self.d_xfake is not None:
+                d_loss_previous = self.compute_loss(
+                    self.discriminator(self.d_xfake, self.d_previous_y),
+                    0) + self.compute_loss(
+                        self.discriminator(self.d_xreal, self.d_previous_y),
+                        1)
+                d_loss_current = self.compute_loss(
+                    self.discriminator(x_fake, y), 0) + self.compute_loss(
+                        self.discriminator(x_real, y), 1)
+                d_loss = (d_loss_current - d_loss_previous) * self.dv
+                total_loss = total_loss + d_loss
+
+            self.d_xreal = x_real
+            self.d_xfake = x_fake
+            self.d_previous_y = y
+
+        # Replicas do not share parameters, so the gradient of the sum is
+        # the per-replica gradient of each replica's own loss
+        total_loss.sum().backward()
+
+        self.d_optimizer.step()
+        toggle_grad(self.discriminator, False)
+
+        # Output
+        return (dloss.detach().cpu().numpy(), d_loss.detach().cpu().numpy(),
+                i_loss.detach().cpu().numpy())
+
+    def replica_mean(self, x):
+        return x.flatten(1).mean(1)
+
+    def compute_loss(self, d_out, target, is_generator=False):
+        if self.gan_type == 'standard':
+            targets = d_out.new_full(size=d_out.size(), fill_value=target)
+            loss = self.replica_mean(
+                F.binary_cross_entropy_with_logits(d_out,
+                                                   targets,
+                                                   reduction='none'))
+        elif self.gan_type == 'wgan':
+            loss = (2 * target - 1) * self.replica_mean(d_out)
+        elif self.gan_type == 'hinge':
+            if is_generator is False:
+                loss = self.replica_mean(F.relu(1 + (2 * target - 1) * d_out))
+            else:
+                loss = self.replica_mean((2 * target - 1) * d_out)
+        elif self.gan_type == 'sigmoid':
+            d_out = d_out * self.config['training']['sigmoid_coe']
+            loss = self.replica_mean(
+                (2 * target - 1) * torch.sigmoid(d_out)
+            ) / self.config['training']['sigmoid_coe']
+        elif self.gan_type == 'lsgan1':
+            if is_generator is False:
+                target = target * 2 - 1
+                loss = self.replica_mean((d_out - target)**2)
+            else:
+                loss = self.replica_mean(d_out**2)
+        elif self.gan_type == 'lsgan2':
+            target -= 0.5
+            loss = self.replica_mean((d_out - target)**2)
+        else:
+            raise NotImplementedError
+
+        return loss
@@ -4,8 +4,10 @@ from torch.nn import functional as F
 import torch.utils.data
 import torch.utils.data.distributed
 from torch import autograd
+from gan_training import utils
 import numpy as np
 from gan_training.random_queue import Random_queue
+from gan_training.config import get_memory_format
 
 
 class Trainer(object):
@@ -54,6 +56,7 @@ class Trainer(object):
             config['training']['batch_size'])
 
         self.max0 = torch.nn.ReLU()
+        self.memory_format = get_memory_format(config)
 
     def generator_trainstep(self, y, z):
         assert (y.size(0) == z.size(0))
@@ -72,7 +75,7 @@ class Trainer(object):
 
         return gloss.item()
 
-    def discriminator_trainstep(self, x_real, y, z, it=0):
+    def discriminator_trainstep(self, x_real, y, z, it=0, x_fake=None):
         # print(it)
         toggle_grad(self.generator, False)
         toggle_grad(self.discriminator, True)
@@ -88,8 +91,9 @@ class Trainer(object):
         dloss_real.backward()
 
         # On fake data
-        with torch.no_grad():
-            x_fake = self.generator(z, y)
+        if x_fake is None:
+            with torch.no_grad():
+                x_fake = self.generator(z, y)
 
         d_fake = self.discriminator(x_fake, y)
         dloss_fake = self.compute_loss(d_fake, 0) * self.pv
@@ -112,10 +116,18 @@ class Trainer(object):
             i_xreal, i_yreal = self.i_real_queue.get_data()
             i_xfake, i_yfake = self.i_fake_queue.get_data()
 
-            i_xreal = torch.as_tensor(i_xreal, dtype=torch.float32).cuda()
-            i_xfake = torch.as_tensor(i_xfake, dtype=torch.float32).cuda()
-            i_yreal = torch.as_tensor(i_yreal, dtype=torch.long).cuda()
-            i_yfake = torch.as_tensor(i_yfake, dtype=torch.long).cuda()
+            device = x_real.device
+            i_xreal = torch.as_tensor(i_xreal,
+                                      dtype=torch.float32,
+                                      device=device)
+            i_xfake = torch.as_tensor(i_xfake,
+                                      dtype=torch.float32,
+                                      device=device)
+            i_yreal = torch.as_tensor(i_yreal, dtype=torch.long, device=device)
+            i_yfake = torch.as_tensor(i_yfake, dtype=torch.long, device=device)
+            if i_xreal.dim() == 4:
+                i_xreal = i_xreal.contiguous(memory_format=self.memory_format)
+                i_xfake = i_xfake.contiguous(memory_format=self.memory_format)
 
             i_real_doutput = self.discriminator(i_xreal, i_yreal)
             i_loss_real = self.compute_loss(i_real_doutput, 1)
@@ -172,6 +184,27 @@ class Trainer(object):
         dloss = (dloss_real + dloss_fake)
         return dloss.item(), d_loss.item(), i_loss.item()
 
+    def state_dict(self):
+        ''' Integral buffers and the previous batch of the derivative term.
+        '''
+        state_dict = dict(i_real_queue=self.i_real_queue.state_dict(),
+                          i_fake_queue=self.i_fake_queue.state_dict())
+        if self.d_xfake is not None:
+            state_dict.update(d_xreal=self.d_xreal,
+                              d_xfake=self.d_xfake,
+                              d_previous_z=self.d_previous_z,
+                              d_previous_y=self.d_previous_y)
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        self.i_real_queue.load_state_dict(state_dict['i_real_queue'])
+        self.i_fake_queue.load_state_dict(state_dict['i_fake_queue'])
+        if 'd_xfake' in state_dict:
+            self.d_xreal = state_dict['d_xreal']
+            self.d_xfake = state_dict['d_xfake']
+            self.d_previous_z = state_dict['d_previous_z']
+            self.d_previous_y = state_dict['d_previous_y']
+
     def compute_loss(self, d_out, target, is_generator=False):
         targets = d_out.new_full(size=d_out.size(), fill_value=target)
 
@@ -238,9 +271,4 @@ def update_average(model_tgt, model_src, beta):
     toggle_grad(model_src, False)
     toggle_grad(model_tgt, False)
 
-    param_dict_src = dict(model_src.named_parameters())
-
-    for p_name, p_tgt in model_tgt.named_parameters():
-        p_src = param_dict_src[p_name]
-        assert (p_src is not p_tgt)
-        p_tgt.copy_(beta * p_tgt + (1. - beta) * p_src)
+    utils.update_average(model_tgt, model_src, beta)
@@ -1,4 +1,6 @@
 
+import random
+import numpy as np
 import torch
 import torch.utils.data
 import torch.utils.data.distributed
@@ -25,9 +27,179 @@ def get_nsamples(data_loader, N):
 
 
 def update_average(model_tgt, model_src, beta):
-    param_dict_src = dict(model_src.named_parameters())
+    ModelAverage(model_tgt, model_src, beta).update(beta)
 
-    for p_name, p_tgt in model_tgt.named_parameters():
-        p_src = param_dict_src[p_name]
-        assert(p_src is not p_tgt)
-        p_tgt.copy_(beta*p_tgt + (1. - beta)*p_src)
+
+class ModelAverage(object):
+    ''' Exponential moving average of a model's parameters.
+
+    Parameter lists are matched by name once, and every update is a single
+    fused multi-tensor lerp. With ema_every > 1 the average is only updated
+    every ema_every calls to step() and beta is raised to the power of
+    ema_every, so the effective time horizon stays the same.
+
+    Args:
+        model_tgt (nn.Module): averaged model
+        model_src (nn.Module): trained model
+        beta (float): decay per step
+        ema_every (int): number of steps between two updates
+        average_buffers (bool): whether to also average floating point
+            buffers (other buffers are copied)
+    '''
+    def __init__(self,
+                 model_tgt,
+                 model_src,
+                 beta,
+                 ema_every=1,
+                 average_buffers=False):
+        self.beta = beta
+        self.ema_every = ema_every
+        self.average_buffers = average_buffers
+        self.nsteps = 0
+
+        param_dict_src = dict(model_src.named_parameters())
+        self.params_tgt = []
+        self.params_src = []
+        for p_name, p_tgt in model_tgt.named_parameters():
+            p_src = param_dict_src[p_name]
+            assert (p_src is not p_tgt)
+            self.params_tgt.append(p_tgt)
+            self.params_src.append(p_src)
+
+        buffer_dict_src = dict(model_src.named_buffers())
+        self.buffers_tgt = []
+        self.buffers_src = []
+        self.buffers_copy = []
+        for b_name, b_tgt in model_tgt.named_buffers():
+            b_src = buffer_dict_src[b_name]
+            if average_buffers and b_tgt.is_floating_point():
+                self.buffers_tgt.append(b_tgt)
+                self.buffers_src.append(b_src)
+            else:
+                self.buffers_copy.append((b_tgt, b_src))
+
+    def step(self):
+        self.nsteps += 1
+        if self.nsteps % self.ema_every == 0:
+            self.update(self.beta**self.ema_every)
+
+    @torch.no_grad()
+    def update(self, beta):
+        foreach_lerp_(self.params_tgt, self.params_src, 1. - beta)
+        if self.average_buffers:
+            if len(self.buffers_tgt) > 0:
+                foreach_lerp_(self.buffers_tgt, self.buffers_src, 1. - beta)
+            for b_tgt, b_src in self.buffers_copy:
+                b_tgt.copy_(b_src)
+
+
+class ModelAverageBank(object):
+    ''' Several exponential moving averages of the same model.
+
+    All shadows share the matched source parameters. Their averaged
+    tensors are concatenated into one list, so that a step advances all of
+    them with one multi-tensor lerp, each tensor with its own weight.
+
+    Args:
+        models_tgt (list): averaged models, one per beta
+        model_src (nn.Module): trained model
+        betas (list): decay per step of each shadow
+        ema_every (int): number of steps between two updates
+        average_buffers (bool): whether to also average floating point
+            buffers (other buffers are copied)
+    '''
+    def __init__(self,
+                 models_tgt,
+                 model_src,
+                 betas,
+                 ema_every=1,
+                 average_buffers=False):
+        assert (len(models_tgt) == len(betas))
+        self.betas = betas
+        self.ema_every = ema_every
+        self.nsteps = 0
+
+        self.averages = []
+        for model_tgt, beta in zip(models_tgt, betas):
+            model_average = ModelAverage(model_tgt,
+                                         model_src,
+                                         beta,
+                                         average_buffers=average_buffers)
+            if len(self.averages) > 0:
+                # Share the source lists of the first shadow
+                model_average.params_src = self.averages[0].params_src
+                model_average.buffers_src = self.averages[0].buffers_src
+            self.averages.append(model_average)
+
+        # Averaged tensors of all shadows, with the source list repeated
+        self.tensors_tgt = []
+        self.tensors_src = []
+        self.sizes = []
+        self.buffers_copy = []
+        for model_average in self.averages:
+            tensors_tgt = model_average.params_tgt
+            tensors_src = model_average.params_src
+            if average_buffers:
+                tensors_tgt = tensors_tgt + model_average.buffers_tgt
+                tensors_src = tensors_src + model_average.buffers_src
+                self.buffers_copy += model_average.buffers_copy
+            self.tensors_tgt += tensors_tgt
+            self.tensors_src += tensors_src
+            self.sizes.append(len(tensors_tgt))
+
+    def step(self):
+        self.nsteps += 1
+        if self.nsteps % self.ema_every == 0:
+            weights = []
+            for beta, size in zip(self.betas, self.sizes):
+                weights += [1. - beta**self.ema_every] * size
+            self.lerp_(weights)
+
+    def update(self, beta):
+        self.lerp_(1. - beta)
+
+    @torch.no_grad()
+    def lerp_(self, weight):
+        foreach_lerp_(self.tensors_tgt, self.tensors_src, weight)
+        for b_tgt, b_src in self.buffers_copy:
+            b_tgt.copy_(b_src)
+
+    def state_dict(self):
+        return dict(nsteps=self.nsteps)
+
+    def load_state_dict(self, state_dict):
+        self.nsteps = state_dict['nsteps']
+
+
+class RNGState(object):
+    ''' Checkpointable state of the torch, cuda, NumPy and Python random
+    number generators.
+    '''
+    def state_dict(self):
+        state_dict = dict(torch=torch.get_rng_state(),
+                          numpy=np.random.get_state(),
+                          random=random.getstate())
+        if torch.cuda.is_available():
+            state_dict['cuda'] = torch.cuda.get_rng_state_all()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        torch.set_rng_state(state_dict['torch'])
+        np.random.set_state(state_dict['numpy'])
+        random.setstate(state_dict['random'])
+        if 'cuda' in state_dict and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state_dict['cuda'])
+
+
+def foreach_lerp_(tensors_tgt, tensors_src, weight):
+    ''' Lerps tensors_tgt towards tensors_src in place, by a scalar weight or
+    a list with one weight per tensor.
+    '''
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(tensors_tgt, tensors_src, weight)
+    elif isinstance(weight, list):
+        for t_tgt, t_src, w in zip(tensors_tgt, tensors_src, weight):
+            t_tgt.lerp_(t_src, w)
+    else:
+        torch._foreach_mul_(tensors_tgt, 1. - weight)
+        torch._foreach_add_(tensors_tgt, tensors_src, alpha=weight)
@@ -0,0 +1,53 @@
+import argparse
+import copy
+import shutil
+from gan_training.config import load_config
+from gan_training.data_cache import get_cache_dir, is_cached, write_cache
+from gan_training.inputs import get_dataset
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Decode, resize and crop the training images once and cache '
+    'them as uint8 shards in data.cache_dir.')
+parser.add_argument('config', type=str, help='Path to config file.')
+parser.add_argument('--shard-mb', type=int, default=1024,
+                    help='Size of one shard in MB.')
+parser.add_argument('--nworkers', type=int, default=-1,
+                    help='Decoding workers, training.nworkers if negative.')
+parser.add_argument('--force', action='store_true',
+                    help='Rebuild an existing cache.')
+args = parser.parse_args()
+
+config = load_config(args.config, 'configs/default.yaml')
+if config['data']['cache_dir'] is None:
+    raise ValueError('Set data.cache_dir in the config.')
+
+name = config['data']['type']
+data_dir = config['data']['train_dir']
+size = config['data']['img_size']
+lsun_categories = config['data']['lsun_categories_train']
+nworkers = args.nworkers
+if nworkers < 0:
+    nworkers = config['training']['nworkers']
+
+cache_dir = get_cache_dir(name, data_dir, size, lsun_categories, config)
+if cache_dir is None:
+    raise ValueError('Dataset type "%s" cannot be cached.' % name)
+if is_cached(cache_dir):
+    if not args.force:
+        print('Cache %s exists already.' % cache_dir)
+        exit(0)
+    shutil.rmtree(cache_dir)
+
+# Source images as uint8 tensors, without the random transforms
+raw_config = copy.deepcopy(config)
+raw_config['data']['batch_augment'] = True
+dataset, nlabels = get_dataset(name=name,
+                               data_dir=data_dir,
+                               size=size,
+                               lsun_categories=lsun_categories,
+                               config=raw_config,
+                               use_cache=False)
+
+print('Caching %d images in %s...' % (len(dataset), cache_dir))
+write_cache(dataset, nlabels, cache_dir, args.shard_mb, nworkers)
@@ -0,0 +1,41 @@
+import argparse
+import sys
+from os import path
+from gan_training.checkpoints import CheckpointIO
+from gan_training.config import load_config, get_out_dir
+from gan_training.supervisor import Supervisor
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Run train.py or train_pid.py and relaunch it until it '
+    'finishes, resuming from the newest checkpoint.')
+parser.add_argument('script',
+                    type=str,
+                    choices=['train.py', 'train_pid.py'],
+                    help='Training script.')
+parser.add_argument('config', type=str, help='Path to config file.')
+parser.add_argument('--max-crashes',
+                    type=int,
+                    default=5,
+                    help='Consecutive crashes to give up after.')
+parser.add_argument('--restart-delay',
+                    type=float,
+                    default=10.,
+                    help='Seconds to wait before relaunching after a crash.')
+parser.add_argument('-key', type=str, default='', help='')
+args, trainer_args = parser.parse_known_args()
+
+config = load_config(args.config, 'configs/default.yaml')
+out_dir = get_out_dir(config, args.key)
+checkpoint_io = CheckpointIO(checkpoint_dir=path.join(out_dir, 'chkpts'))
+
+cmd = [
+    sys.executable, args.script, args.config, '-key', args.key,
+    '--auto-resume'
+] + trainer_args
+supervisor = Supervisor(cmd,
+                        checkpoint_io,
+                        path.join(out_dir, 'supervisor.json'),
+                        max_crashes=args.max_crashes,
+                        restart_delay=args.restart_delay)
+sys.exit(supervisor.run())
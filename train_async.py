@@ -0,0 +1,120 @@
+import utils_log
+from gan_training.config import load_config, build_models
+from gan_training.checkpoints import CheckpointIO
+from gan_training.logger import Logger
+from gan_training.train_async import (
+    SharedModel,
+    generator_worker,
+    discriminator_worker,
+)
+import torch.multiprocessing as mp
+import queue
+import shutil
+import time
+from os import path
+import os
+import argparse
+import sys
+import torch
+
+
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description='Train G and D asynchronously in separate processes.')
+    parser.add_argument('config', type=str, help='Path to config file.')
+    parser.add_argument('-key', type=str, default='', help='')
+    args = parser.parse_args()
+
+    config = load_config(args.config, 'configs/default.yaml')
+
+    if config['data']['nlabels'] > 1:
+        raise NotImplementedError(
+            'Asynchronous training only supports unconditional models.')
+
+    out_dir = "{}{}_{}_async_{}".format(config['training']['out_dir'],
+                                        time.strftime("%Y-%m-%d-%H-%M-%S"),
+                                        config['training']['out_basename'],
+                                        args.key)
+    checkpoint_dir = path.join(out_dir, 'chkpts')
+
+    # Create missing directories
+    if not path.exists(out_dir):
+        os.makedirs(out_dir)
+    if not path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    shutil.copy(args.config, os.path.join(out_dir, "config.yaml"))
+
+    logger = Logger(log_dir=path.join(out_dir, 'logs'),
+                    img_dir=path.join(out_dir, 'imgs'),
+                    monitoring=config['training']['monitoring'],
+                    monitoring_dir=path.join(out_dir, 'monitoring'))
+    text_logger = utils_log.build_logger(out_dir)
+
+    # Models live on the CPU, every worker gets its own threads
+    torch.manual_seed(config['async']['seed'])
+    generator, discriminator = build_models(config)
+    print(generator)
+    print(discriminator)
+
+    shared_g = SharedModel(generator)
+    shared_d = SharedModel(discriminator)
+    fake_queue = mp.Queue(maxsize=config['async']['queue_size'])
+    stats_queue = mp.Queue()
+    g_step = mp.Value('l', 0)
+    d_step = mp.Value('l', 0)
+    stop = mp.Event()
+
+    worker_args = (config, shared_g, shared_d, fake_queue, stats_queue,
+                   g_step, d_step, stop)
+    workers = [
+        mp.Process(target=generator_worker,
+                   name='generator',
+                   args=worker_args),
+        mp.Process(target=discriminator_worker,
+                   name='discriminator',
+                   args=worker_args),
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Collect reports until the discriminator has finished or a worker has
+    # died
+    print('Start training...')
+    while not stop.is_set() or not stats_queue.empty():
+        if not all(worker.is_alive() for worker in workers):
+            # A killed worker never sets stop itself
+            stop.set()
+        try:
+            stats = stats_queue.get(timeout=1.)
+        except queue.Empty:
+            continue
+        name, it = stats['worker'], stats['step']
+        logger.add('losses', name, stats['loss'], it=it)
+        logger.add('async', name + '_steps_per_sec', stats['steps_per_sec'],
+                   it=it)
+        logger.add('async', name + '_staleness', stats['staleness'], it=it)
+        text_logger.info(
+            '[%s, it %6d] loss = %9.4f, %.2f steps/sec, staleness = %.2f' %
+            (name, it, stats['loss'], stats['steps_per_sec'],
+             stats['staleness']))
+
+    for worker in workers:
+        worker.join()
+
+    checkpoint_io = CheckpointIO(checkpoint_dir=checkpoint_dir)
+    checkpoint_io.register_modules(generator=shared_g.model,
+                                   discriminator=shared_d.model)
+    checkpoint_io.save(config['training']['model_file'],
+                       it=shared_d.version.value)
+    logger.save_stats('stats.p')
+
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if len(failed) > 0:
+        text_logger.error('Workers %s failed.' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    mp.set_start_method('spawn')
+    main()
@@ -4,21 +4,32 @@ from gan_training.config import (
     build_models,
     build_optimizers,
     build_lr_scheduler,
+    build_model_average,
+    get_memory_format,
+    get_out_dir,
 )
 from gan_training.eval import Evaluator
 from gan_training.distributions import get_ydist, get_zdist
-from gan_training.inputs import get_dataset
+from gan_training.inputs import (
+    get_dataset,
+    get_batch_augment,
+    InMemoryLoader,
+    ResumableSampler,
+    SeededDataset,
+)
+from gan_training.autobatch import probe_batch_size, save_batch_size
 from gan_training.checkpoints import CheckpointIO
+from gan_training.supervisor import StopSignal, RESTART_EXIT_CODE
 from gan_training.logger import Logger
-from gan_training.train_pid import Trainer, update_average
+from gan_training.train_pid import Trainer
 from gan_training import utils
 from torch import nn
 import shutil
-import copy
 import time
 from os import path
 import os
 import argparse
+import json
 import torch
 import numpy as np
 
@@ -35,6 +46,12 @@ parser.add_argument('--oldmodel',
                     default='',
                     help='Path to previous file.')
 parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('--auto-batch',
+                    action='store_true',
+                    help='Probe the batch size with the best throughput.')
+parser.add_argument('--auto-resume',
+                    action='store_true',
+                    help='Resume from the newest valid checkpoint.')
 parser.add_argument('-key', type=str, default='', help='')
 args = parser.parse_args()
 
@@ -49,9 +66,9 @@ inception_every = config['training']['inception_every']
 save_every = config['training']['save_every']
 backup_every = config['training']['backup_every']
 sample_nlabels = config['training']['sample_nlabels']
+sparse_embeddings = config['training']['sparse_embeddings']
 
-out_dir = "{}{}_{}_{}".format(config['training']['out_dir'], "Plot",
-                              config['training']['out_basename'], args.key)
+out_dir = get_out_dir(config, args.key)
 checkpoint_dir = path.join(out_dir, 'chkpts')
 
 # Create missing directories
@@ -65,6 +82,7 @@ shutil.copy(args.config, os.path.join(out_dir, "config.yaml"))
 checkpoint_io = CheckpointIO(checkpoint_dir=checkpoint_dir)
 
 device = torch.device("cuda:0" if is_cuda else "cpu")
+memory_format = get_memory_format(config)
 
 # Dataset
 train_dataset, nlabels = get_dataset(
@@ -73,14 +91,46 @@ train_dataset, nlabels = get_dataset(
     size=config['data']['img_size'],
     lsun_categories=config['data']['lsun_categories_train'],
     config=config)
-train_loader = torch.utils.data.DataLoader(
-    train_dataset,
-    batch_size=batch_size,
-    num_workers=config['training']['nworkers'],
-    shuffle=True,
-    pin_memory=True,
-    sampler=None,
-    drop_last=True)
+
+# Pick the batch size if requested. A relaunch into the same run keeps
+# the batch size its checkpoints and epoch positions were written with.
+auto_batch_file = path.join(out_dir, 'auto_batch.json')
+if args.auto_batch and path.exists(auto_batch_file):
+    with open(auto_batch_file) as f:
+        batch_size = json.load(f)['batch_size']
+elif args.auto_batch:
+    batch_size, probe_results = probe_batch_size(config, Trainer,
+                                                 train_dataset[0][0].shape,
+                                                 device)
+    with open(auto_batch_file, 'w') as f:
+        json.dump(dict(batch_size=batch_size, results=probe_results),
+                  f,
+                  indent=2)
+if args.auto_batch:
+    print('Using batch size %d' % batch_size)
+    config['training']['batch_size'] = batch_size
+    save_batch_size(path.join(out_dir, 'config.yaml'), batch_size)
+
+# Flip, normalization and noise on the device, if not done in the workers
+batch_augment = get_batch_augment(config)
+
+if config['data']['in_memory']:
+    # The whole dataset on the device, the loader is also the sampler
+    train_loader = InMemoryLoader(train_dataset,
+                                  batch_size,
+                                  device,
+                                  nworkers=config['training']['nworkers'])
+    train_sampler = train_loader
+else:
+    train_sampler = ResumableSampler(train_dataset)
+    train_loader = torch.utils.data.DataLoader(
+        SeededDataset(train_dataset),
+        batch_size=batch_size,
+        num_workers=config['training']['nworkers'],
+        pin_memory=True,
+        sampler=train_sampler,
+        drop_last=True,
+        generator=torch.Generator())
 # toy_data = config['data']['type'].lower() in ['mog']
 
 # Number of labels
@@ -129,16 +179,21 @@ zdist = get_zdist(config['z_dist']['type'],
 
 ntest = batch_size
 x_real_test, ytest = utils.get_nsamples(train_loader, ntest)
+if batch_augment is not None:
+    x_real_test = batch_augment(x_real_test)
 ytest.clamp_(None, nlabels - 1)
 ztest = zdist.sample((ntest, ))
 utils.save_images(x_real_test, path.join(out_dir, 'real.png'))
 
 # Test generator
 if config['training']['take_model_average']:
-    generator_test = copy.deepcopy(generator)
-    checkpoint_io.register_modules(generator_test=generator_test)
+    generator_tests, model_average = build_model_average(generator, config)
+    checkpoint_io.register_modules(model_average=model_average,
+                                   **generator_tests)
+    generator_test = generator_tests['generator_test']
 else:
     generator_test = generator
+    generator_tests = dict(generator_test=generator_test)
 
 # Evaluator
 evaluator = Evaluator(generator_test,
@@ -153,8 +208,11 @@ tstart = t0 = time.time()
 # Load checkpoint if it exists
 try:
     load_dict = dict({})
-    if len(args.oldmodel) > 0:
-        load_dict = checkpoint_io.load(args.oldmodel)
+    resume_file = args.oldmodel
+    if args.auto_resume:
+        resume_file = checkpoint_io.latest_checkpoint() or resume_file
+    if len(resume_file) > 0:
+        load_dict = checkpoint_io.load(resume_file)
 except FileNotFoundError:
     it = epoch_idx = -1
     print("No loaded model, from initialization")
@@ -165,11 +223,13 @@ else:
     it = load_dict.get('it', -1)
     epoch_idx = load_dict.get('epoch_idx', -1)
     logger.load_stats('stats.p')
+    # stats.p can be newer than a backup the run resumed from
+    logger.truncate_stats(it)
 
 # Reinitialize model average if needed
 if (config['training']['take_model_average']
         and config['training']['model_average_reinit']):
-    update_average(generator_test, generator, 0.)
+    model_average.update(0.)
 
 # Learning rate anneling
 g_scheduler = build_lr_scheduler(g_optimizer, config, last_epoch=it)
@@ -188,15 +248,37 @@ trainer = Trainer(generator,
                   dv=config['training']['dv'],
                   batch_size=config['training']['batch_size'],
                   config=config)
+checkpoint_io.register_modules(trainer=trainer)
+if 'trainer' in load_dict:
+    trainer.load_state_dict(load_dict['trainer'])
+
+# Emergency save on SIGTERM/SIGUSR1
+stop_signal = StopSignal()
+
+# Random number generators, restored last so that nothing above draws from
+# the restored streams
+rng_state = utils.RNGState()
+checkpoint_io.register_modules(rng=rng_state)
+if 'rng' in load_dict:
+    rng_state.load_state_dict(load_dict['rng'])
+
+# Continue in the middle of the saved epoch
+epoch_it = load_dict.get('epoch_it', 0)
+if 0 < epoch_it < len(train_dataset) // batch_size:
+    epoch_idx -= 1
+else:
+    epoch_it = 0
 
 # Training loop
 print('Start training...')
 while epoch_idx < 1600:
     epoch_idx += 1
     print('Start epoch %d...' % epoch_idx)
+    train_sampler.set_epoch(epoch_idx, epoch_it * batch_size)
 
     for x_real, y in train_loader:
         it += 1
+        epoch_it += 1
         g_scheduler.step()
         d_scheduler.step()
 
@@ -205,7 +287,11 @@ while epoch_idx < 1600:
         logger.add('learning_rates', 'discriminator', d_lr, it=it)
         logger.add('learning_rates', 'generator', g_lr, it=it)
 
-        x_real, y = x_real.to(device), y.to(device)
+        x_real = x_real.to(device, non_blocking=True)
+        if batch_augment is not None:
+            x_real = batch_augment(x_real)
+        x_real = x_real.contiguous(memory_format=memory_format)
+        y = y.to(device)
         y.clamp_(None, nlabels - 1)
 
         # Discriminator updates
@@ -222,9 +308,7 @@ while epoch_idx < 1600:
             logger.add('losses', 'generator', gloss, it=it)
 
             if config['training']['take_model_average']:
-                update_average(generator_test,
-                               generator,
-                               beta=config['training']['model_average_beta'])
+                model_average.step()
 
         # Print stats
         if it % 100 == 0:
@@ -249,9 +333,17 @@ while epoch_idx < 1600:
         if evaluation_flag is True or (inception_every > 0 and
                                        ((it + 1) % inception_every) == 0):
             evaluation_flag = False
-            inception_mean, inception_std = evaluator.compute_inception_score()
+            inception_scores = evaluator.compute_inception_scores(
+                generator_tests)
+            inception_mean, inception_std = inception_scores.pop(
+                'generator_test')
             logger.add('inception_score', 'mean', inception_mean, it=it)
             logger.add('inception_score', 'stddev', inception_std, it=it)
+            for name, (shadow_mean, shadow_std) in inception_scores.items():
+                logger.add('inception_score', 'mean_' + name, shadow_mean,
+                           it=it)
+                logger.add('inception_score', 'stddev_' + name, shadow_std,
+                           it=it)
             text_logger.info(
                 '[epoch %0d, it %4d] inception_mean: %.4f, inception_std: %.4f'
                 % (epoch_idx, it, inception_mean, inception_std))
@@ -259,15 +351,42 @@ while epoch_idx < 1600:
         # (iii) Backup if necessary
         if ((it + 1) % backup_every) == 0:
             text_logger.info('Saving backup...')
-            checkpoint_io.save('model_%08d.pt' % it, it=it)
+            if sparse_embeddings:
+                # Rows of labels missing from recent batches are stale
+                d_optimizer.catch_up()
+            checkpoint_io.save('model_%08d.pt' % it,
+                               it=it,
+                               epoch_idx=epoch_idx,
+                               epoch_it=epoch_it)
             logger.save_stats('stats_%08d.p' % it)
 
         # # (iv) Save checkpoint if necessary
         if time.time() - t0 > save_every:
             text_logger.info('Saving checkpoint...')
-            checkpoint_io.save(model_file, it=it)
+            if sparse_embeddings:
+                d_optimizer.catch_up()
+            checkpoint_io.save(model_file,
+                               it=it,
+                               epoch_idx=epoch_idx,
+                               epoch_it=epoch_it)
             logger.save_stats('stats.p')
             t0 = time.time()
 
         #     if (restart_every > 0 and t0 - tstart > restart_every):
         #         exit(3)
+
+        # (v) Save and exit if the run is being preempted
+        if stop_signal.received:
+            text_logger.info('Received %s, saving checkpoint...' %
+                             stop_signal.name)
+            if sparse_embeddings:
+                d_optimizer.catch_up()
+            checkpoint_io.save(model_file,
+                               it=it,
+                               epoch_idx=epoch_idx,
+                               epoch_it=epoch_it)
+            logger.save_stats('stats.p')
+            exit(RESTART_EXIT_CODE)
+
+    # The next epoch starts from its first batch
+    epoch_it = 0
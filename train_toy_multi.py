@@ -0,0 +1,248 @@
+import utils_log
+from gan_training.config import (
+    load_config,
+    build_models,
+    build_optimizers,
+    build_lr_scheduler,
+)
+from gan_training.distributions import get_ydist, get_zdist
+from gan_training.eval import mixture_mode_stats
+from gan_training.inputs import get_dataset, MixtureOfGaussianLoader
+from gan_training.checkpoints import CheckpointIO
+from gan_training.logger import Logger
+from gan_training.train_multi import ReplicaStack, MultiTrainer
+import itertools
+import shutil
+import json
+import time
+from os import path
+import os
+import argparse
+import torch
+import numpy as np
+
+torch.backends.cudnn.deterministic = True
+torch.backends.cudnn.benchmark = False
+np.random.seed(1235)
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='Train a sweep of toy GANs as stacked replicas.')
+parser.add_argument('config', type=str, help='Path to config file.')
+parser.add_argument('--no-cuda', action='store_true', help='Do not use cuda.')
+parser.add_argument('-key', type=str, default='', help='')
+args = parser.parse_args()
+
+config = load_config(args.config, 'configs/default.yaml')
+is_cuda = (torch.cuda.is_available() and not args.no_cuda)
+
+# Short hands
+batch_size = config['training']['batch_size']
+d_steps = config['training']['d_steps']
+save_every = config['training']['save_every']
+backup_every = config['training']['backup_every']
+sample_every = config['training']['sample_every']
+log_every = config['multi']['log_every']
+niter = config['multi']['niter']
+
+out_dir = "{}{}_{}_multi_{}".format(config['training']['out_dir'],
+                                    time.strftime("%Y-%m-%d-%H-%M-%S"),
+                                    config['training']['out_basename'],
+                                    args.key)
+checkpoint_dir = path.join(out_dir, 'chkpts')
+sample_dir = path.join(out_dir, 'samples')
+
+# Create missing directories
+for d in [out_dir, checkpoint_dir, sample_dir]:
+    if not path.exists(d):
+        os.makedirs(d)
+shutil.copy(args.config, os.path.join(out_dir, "config.yaml"))
+
+# Sweep: cartesian product of the per-replica settings
+sweep = [
+    dict(zip(['pv', 'iv', 'dv', 'seed'], v)) for v in itertools.product(
+        config['multi']['pv'], config['multi']['iv'], config['multi']['dv'],
+        config['multi']['seed'])
+]
+nreplicas = len(sweep)
+with open(path.join(out_dir, 'replicas.json'), 'w') as f:
+    json.dump(sweep, f, indent=2)
+print('Training %d replicas' % nreplicas)
+
+# Logger
+checkpoint_io = CheckpointIO(checkpoint_dir=checkpoint_dir)
+
+device = torch.device("cuda:0" if is_cuda else "cpu")
+
+# Dataset: one batch per replica is drawn at once
+train_dataset, nlabels = get_dataset(
+    name=config['data']['type'],
+    data_dir=config['data']['train_dir'],
+    size=config['data']['img_size'],
+    lsun_categories=config['data']['lsun_categories_train'],
+    config=config)
+if config['data']['type'].lower() == 'mog':
+    train_loader = MixtureOfGaussianLoader(train_dataset,
+                                           batch_size * nreplicas, device)
+else:
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=batch_size * nreplicas,
+        num_workers=config['training']['nworkers'],
+        shuffle=True,
+        pin_memory=True,
+        sampler=None,
+        drop_last=True)
+
+# Create models, each replica from its own seed
+generators, discriminators = [], []
+for setting in sweep:
+    torch.manual_seed(setting['seed'])
+    generator, discriminator = build_models(config)
+    generators.append(generator)
+    discriminators.append(discriminator)
+print(generators[0])
+print(discriminators[0])
+
+generator = ReplicaStack(generators).to(device)
+discriminator = ReplicaStack(discriminators).to(device)
+del generators, discriminators
+
+# Elementwise optimizers treat the stacked parameters exactly like K
+# independent optimizers
+g_optimizer, d_optimizer = build_optimizers(generator, discriminator, config)
+
+# Register modules to checkpoint
+checkpoint_io.register_modules(
+    generator=generator,
+    discriminator=discriminator,
+    g_optimizer=g_optimizer,
+    d_optimizer=d_optimizer,
+)
+
+logger = Logger(log_dir=path.join(out_dir, 'logs'),
+                img_dir=path.join(out_dir, 'imgs'),
+                monitoring=config['training']['monitoring'],
+                monitoring_dir=path.join(out_dir, 'monitoring'))
+
+text_logger = utils_log.build_logger(out_dir)
+
+# Distributions
+ydist = get_ydist(nlabels, device=device)
+zdist = get_zdist(config['z_dist']['type'],
+                  config['z_dist']['dim'],
+                  device=device)
+ztest = zdist.sample((nreplicas, 10000))
+ytest = torch.zeros(nreplicas, 10000, dtype=torch.int64, device=device)
+
+# Learning rate anneling
+it = -1
+g_scheduler = build_lr_scheduler(g_optimizer, config, last_epoch=it)
+d_scheduler = build_lr_scheduler(d_optimizer, config, last_epoch=it)
+
+
+def coefficients(name):
+    return torch.tensor([s[name] for s in sweep],
+                        dtype=torch.float32,
+                        device=device)
+
+
+trainer = MultiTrainer(generator,
+                       discriminator,
+                       g_optimizer,
+                       d_optimizer,
+                       gan_type=config['training']['gan_type'],
+                       pv=coefficients('pv'),
+                       iv=coefficients('iv'),
+                       dv=coefficients('dv'),
+                       batch_size=batch_size,
+                       config=config)
+
+
+def replica_metrics(it):
+    generator.eval()
+    with torch.no_grad():
+        x_fake = generator(ztest, ytest)
+    np.save(path.join(sample_dir, '%08d.npy' % it), x_fake.cpu().numpy())
+    if train_dataset.centers is None:
+        return
+    modes, hq_ratio = mixture_mode_stats(x_fake, train_dataset.centers,
+                                         train_dataset.std)
+    for k in range(nreplicas):
+        logger.add('replica_%03d' % k, 'modes', modes[k].item(), it=it)
+        logger.add('replica_%03d' % k, 'hq_ratio', hq_ratio[k].item(), it=it)
+
+
+def save_metrics():
+    metrics = []
+    for k, setting in enumerate(sweep):
+        stats = logger.stats.get('replica_%03d' % k, {})
+        metrics.append(
+            dict(setting,
+                 **{key: float(stats[key][-1][1])
+                    for key in stats}))
+    with open(path.join(out_dir, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
+
+
+# Training loop
+print('Start training...')
+tstart = t0 = time.time()
+gloss = np.zeros(nreplicas)
+while it < niter:
+    for x_real, y in train_loader:
+        it += 1
+        if it >= niter:
+            break
+        g_scheduler.step()
+        d_scheduler.step()
+
+        x_real = x_real.to(device).view(nreplicas, batch_size, -1)
+        y = y.to(device).view(nreplicas, batch_size)
+        y.clamp_(None, nlabels - 1)
+
+        # Discriminator updates
+        z = zdist.sample((nreplicas, batch_size))
+        dloss, dl, il = trainer.discriminator_trainstep(x_real, y, z, it)
+
+        # Generators updates
+        if ((it + 1) % d_steps) == 0:
+            z = zdist.sample((nreplicas, batch_size))
+            gloss = trainer.generator_trainstep(y, z)
+
+        # Per-replica losses
+        if it % log_every == 0:
+            for k in range(nreplicas):
+                logger.add('replica_%03d' % k, 'discriminator', dloss[k], it=it)
+                logger.add('replica_%03d' % k, 'd_loss', dl[k], it=it)
+                logger.add('replica_%03d' % k, 'i_loss', il[k], it=it)
+                logger.add('replica_%03d' % k, 'generator', gloss[k], it=it)
+
+        # Print stats
+        if it % 100 == 0:
+            text_logger.info(
+                '[it %6d] %.1f it/s, mean g_loss = %9.4f, mean d_loss = %9.4f'
+                % (it, it / (time.time() - tstart + 1e-8), np.mean(gloss),
+                   np.mean(dloss)))
+
+        # (i) Per-replica samples and mode statistics
+        if (it % sample_every) == 0:
+            replica_metrics(it)
+            save_metrics()
+
+        # (ii) Backup if necessary
+        if ((it + 1) % backup_every) == 0:
+            text_logger.info('Saving backup...')
+            checkpoint_io.save('model_%08d.pt' % it, it=it)
+
+        # (iii) Save checkpoint if necessary
+        if time.time() - t0 > save_every:
+            text_logger.info('Saving checkpoint...')
+            checkpoint_io.save('model.pt', it=it)
+            logger.save_stats('stats.p')
+            t0 = time.time()
+
+replica_metrics(it)
+save_metrics()
+checkpoint_io.save('model.pt', it=it)
+logger.save_stats('stats.p')